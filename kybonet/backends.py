@@ -0,0 +1,295 @@
+import asyncio
+import collections
+import math
+import os
+import threading
+import time
+from evdev import InputEvent, ecodes
+from .discovery import list_devices, device_info, HotplugWatcher
+from .input_devices import FakeDevice, NullDevice
+
+# Where the server reads its events from and where the client writes them.
+#
+# Inputs: list() returns the devices that can be opened, as objects with a
+# name, a path, a capabilities dict and open(); info(path) the same for one
+# path (None if it's gone or isn't a mouse or a keyboard); watcher() an
+# object for the hotplug notifications (see discovery.HotplugWatcher), or
+# raises OSError. An opened device has what the server uses of an
+# evdev.InputDevice: name, path, capabilities(), fileno(), read() (raising
+# BlockingIOError when there's nothing to read), async_read(), grab(),
+# ungrab() and close().
+#
+# Sinks: what the client uses of input_devices.EventWriter: write_events(),
+# write_frames(), the `pressed` set, stats() and close().
+
+MOUSE_CAPABILITIES = {
+    ecodes.EV_KEY: [ecodes.BTN_LEFT, ecodes.BTN_RIGHT, ecodes.BTN_MIDDLE],
+    ecodes.EV_REL: [ecodes.REL_X, ecodes.REL_Y, ecodes.REL_WHEEL]}
+
+KEYBOARD_CAPABILITIES = {
+    ecodes.EV_KEY: list(range(ecodes.KEY_ESC, ecodes.KEY_MICMUTE + 1))}
+
+SINKS = ('uinput', 'null', 'memory')
+
+
+def _syn(sec, usec):
+    return InputEvent(sec, usec, ecodes.EV_SYN, ecodes.SYN_REPORT, 0)
+
+
+def mouse_trace(n_reports, rate=1000, reports_per_read=4, click_every=250):
+    # A 1000 Hz mouse drawing circles, with a click every now and then.
+    reads = []
+    read = []
+    for i in range(n_reports):
+        t = i / rate
+        sec, usec = int(t), int((t % 1) * 1e6)
+        angle = 2 * math.pi * t
+        dx = int(round(8 * math.cos(angle)))
+        dy = int(round(8 * math.sin(angle)))
+        if dx:
+            read.append(InputEvent(sec, usec, ecodes.EV_REL, ecodes.REL_X, dx))
+        if dy:
+            read.append(InputEvent(sec, usec, ecodes.EV_REL, ecodes.REL_Y, dy))
+        if click_every and i % click_every == 0:
+            value = (i // click_every) % 2 == 0
+            read.append(InputEvent(sec, usec, ecodes.EV_KEY, ecodes.BTN_LEFT,
+                                   int(value)))
+        read.append(_syn(sec, usec))
+        if (i + 1) % reports_per_read == 0:
+            reads.append(read)
+            read = []
+    if read:
+        reads.append(read)
+    return reads
+
+
+def keyboard_trace(n_keys, rate=20):
+    # A fast typist: every key is pressed and released in its own read.
+    reads = []
+    keys = [ecodes.KEY_A + i for i in range(10)]
+    for i in range(n_keys):
+        t = i / rate
+        sec, usec = int(t), int((t % 1) * 1e6)
+        code = keys[i % len(keys)]
+        for value in (1, 0):
+            reads.append([
+                InputEvent(sec, usec, ecodes.EV_MSC, ecodes.MSC_SCAN, code),
+                InputEvent(sec, usec, ecodes.EV_KEY, code, value),
+                _syn(sec, usec)])
+    return reads
+
+
+class EvdevInputs:
+    # The devices in /dev/input (the default).
+    def list(self):
+        return list_devices()
+
+    def info(self, path):
+        return device_info(path)
+
+    def watcher(self):
+        return HotplugWatcher()
+
+
+class FakeInputDevice:
+    # A device that is never read: its events are given to the server with
+    # feed() or parse_events().
+    def __init__(self, name, capabilities):
+        self.name = name
+        self.path = None
+        self._capabilities = capabilities
+
+    def capabilities(self):
+        return self._capabilities
+
+    def grab(self):
+        pass
+
+    def ungrab(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SyntheticDevice(FakeInputDevice):
+    # Replays `reads` in a loop, one every `interval` seconds, stamped with
+    # the time they are generated. A thread marks each read as due by
+    # writing a byte to a pipe, so the device can be waited on (selector,
+    # asyncio) as a real one, and reads pile up if they aren't drained.
+    def __init__(self, name, capabilities, reads, interval, path=None):
+        super().__init__(name, capabilities)
+        self.path = path
+        self._reads = reads
+        self._interval = interval
+        self._next = 0
+        self._due = collections.deque()
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+        self._closed = threading.Event()
+        self.grabbed = False
+        # stats
+        self.reads = 0
+        self.events = 0
+        self._thread = threading.Thread(target=self._generate, name=name,
+                                        daemon=True)
+        self._thread.start()
+
+    def fileno(self):
+        return self._read_fd
+
+    def grab(self):
+        self.grabbed = True
+
+    def ungrab(self):
+        self.grabbed = False
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._thread.join()
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+    def _generate(self):
+        deadline = time.monotonic()
+        while not self._closed.wait(max(deadline - time.monotonic(), 0)):
+            self._due.append(time.time())
+            os.write(self._write_fd, b'\0')
+            deadline += self._interval
+
+    def read(self):
+        # Raises BlockingIOError when nothing is due, as evdev does.
+        count = len(os.read(self._read_fd, 4096))
+        events = []
+        for _ in range(count):
+            t = self._due.popleft()
+            sec, usec = int(t), int((t % 1) * 1e6)
+            read = self._reads[self._next]
+            self._next = (self._next + 1) % len(self._reads)
+            events.extend(InputEvent(sec, usec, e.type, e.code, e.value)
+                          for e in read)
+        self.reads += count
+        self.events += len(events)
+        return events
+
+    async def async_read(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                return self.read()
+            except BlockingIOError:
+                pass
+            ready = loop.create_future()
+            loop.add_reader(self._read_fd,
+                            lambda: ready.done() or ready.set_result(None))
+            try:
+                await ready
+            finally:
+                loop.remove_reader(self._read_fd)
+
+
+class SyntheticInfo:
+    # A synthetic device before it's opened (see DeviceInfo).
+    def __init__(self, path, name, capabilities, role, open_device):
+        self.path = path
+        self.name = name
+        self.capabilities = capabilities
+        self.role = role
+        self._open = open_device
+
+    def open(self):
+        return self._open()
+
+
+class SyntheticInputs:
+    # A keyboard typing `keyboard_rate` keys per second and a mouse
+    # reporting `mouse_rate` times per second (`reports_per_read` reports in
+    # each read), for machines without input devices. A rate of 0 leaves
+    # that device out.
+    keyboard_name = 'kybonet synthetic keyboard'
+    mouse_name = 'kybonet synthetic mouse'
+
+    def __init__(self, keyboard_rate=20, mouse_rate=1000, reports_per_read=4):
+        self._infos = []
+        if keyboard_rate:
+            # a press and a release per key
+            self._infos.append(SyntheticInfo(
+                'synthetic://keyboard', self.keyboard_name,
+                KEYBOARD_CAPABILITIES, 'keyboard',
+                lambda: SyntheticDevice(
+                            self.keyboard_name, KEYBOARD_CAPABILITIES,
+                            keyboard_trace(100, rate=keyboard_rate),
+                            1.0 / keyboard_rate / 2, 'synthetic://keyboard')))
+        if mouse_rate:
+            self._infos.append(SyntheticInfo(
+                'synthetic://mouse', self.mouse_name, MOUSE_CAPABILITIES,
+                'mouse',
+                lambda: SyntheticDevice(
+                            self.mouse_name, MOUSE_CAPABILITIES,
+                            mouse_trace(mouse_rate, rate=mouse_rate,
+                                        reports_per_read=reports_per_read),
+                            reports_per_read / mouse_rate,
+                            'synthetic://mouse')))
+
+    def list(self):
+        return list(self._infos)
+
+    def info(self, path):
+        return next((i for i in self._infos if i.path == path), None)
+
+    def watcher(self):
+        raise OSError('synthetic devices are never plugged')
+
+
+class MemorySink:
+    # Records what is injected instead of injecting it: the last `keep`
+    # frames (None: all of them) and the counts.
+    def __init__(self, keep=10000):
+        self.frames = collections.deque(maxlen=keep)
+        self.pressed = set()
+        self._started = time.monotonic()
+        self.writes = 0
+        self.events = 0
+
+    def write_events(self, events):
+        if events:
+            self.write_frames([events])
+
+    def write_frames(self, frames):
+        ev_key = ecodes.EV_KEY
+        for events in frames:
+            if not events:
+                continue
+            for e in events:
+                if e.etype == ev_key:
+                    if e.value == 1:
+                        self.pressed.add(e.code)
+                    elif e.value == 0:
+                        self.pressed.discard(e.code)
+            self.frames.append(list(events))
+            self.events += len(events)
+        self.writes += 1
+
+    def stats(self):
+        elapsed = time.monotonic() - self._started
+        return 'writes={} events={} ({:.0f}/s) pressed={}'.format(
+                    self.writes, self.events,
+                    self.events / elapsed if elapsed else 0,
+                    sorted(self.pressed))
+
+    def close(self):
+        pass
+
+
+def open_sink(kind='uinput', name='my-fake-device', capabilities='full'):
+    # kind: 'uinput' (the virtual device, needs /dev/uinput), 'null' (the
+    # same writes, to /dev/null) or 'memory' (see MemorySink).
+    if kind == 'uinput':
+        return FakeDevice(name=name, capabilities=capabilities)
+    if kind == 'null':
+        return NullDevice()
+    if kind == 'memory':
+        return MemorySink()
+    raise ValueError('Unknown sink: "{}"'.format(kind))
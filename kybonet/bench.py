@@ -0,0 +1,607 @@
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import zmq
+from evdev import ecodes
+from .backends import FakeInputDevice, MemorySink, MOUSE_CAPABILITIES, \
+                       KEYBOARD_CAPABILITIES, mouse_trace, keyboard_trace
+from .server import KybonetServer
+from .client import KybonetClient
+from .pipeline import Stage
+from .crypto import generate_keys, serialize_public_key, \
+                    serialize_private_key, fingerprint, \
+                    encrypt, decrypt, SessionKey
+from .input_devices import PseudoEvent, EventBatch, DeviceProfile, \
+                           MotionCoalescer, NullDevice
+from .protocol import pack_payload, pack_batch, unpack_payload, \
+                      pack_json_payload
+
+logger = logging.getLogger(__name__)
+
+BENCHMARKS = ('parse', 'merge', 'coalesce', 'crypto', 'serialize', 'inject',
+              'priority', 'mirror', 'loop', 'datagram', 'startup')
+
+# Module imported by each console entry point.
+ENTRY_POINTS = {'server': 'kybonet.server',
+                'client': 'kybonet.client',
+                'devices': 'kybonet.input_devices',
+                'keygen': 'kybonet.crypto'}
+
+_import_script = '''
+import time
+start = time.perf_counter()
+import {}
+print(time.perf_counter() - start)
+'''
+
+# argv: spawn time (wall clock), private key file, server endpoint.
+_first_event_script = '''
+import sys
+import time
+from kybonet.client import KybonetClient
+from kybonet.crypto import import_private_key, fingerprint
+with open(sys.argv[2], 'rb') as f:
+    key = import_private_key(f.read())
+client = KybonetClient()
+client.connect_endpoint(sys.argv[3], topic=fingerprint(key.public_key()))
+while not client.receive(key):
+    pass
+print(time.time() - float(sys.argv[1]))
+'''
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmarks', nargs='*', default=list(BENCHMARKS),
+                        help='Benchmarks to run: {} (default: all).'.format(
+                            ', '.join(BENCHMARKS)))
+    parser.add_argument('-n', '--events', type=int, default=20000,
+                        help='Approximate number of events per benchmark.')
+    parser.add_argument('-r', '--reports-per-read', type=int, default=4,
+                        help='Mouse reports returned by each device read.')
+    parser.add_argument('-e', '--encryption', type=str, default='session',
+                        choices=('session', 'rsa'),
+                        help='Encryption mode of the loop benchmark.')
+    parser.add_argument('-t', '--transport', type=str, default='inproc',
+                        choices=('inproc', 'tcp'),
+                        help='zmq transport of the loop benchmark.')
+    parser.add_argument('--loss', type=float, default=0.05,
+                        help='Datagrams dropped in the datagram benchmark '
+                        '(0 to 1).')
+    parser.add_argument('--reorder', type=float, default=0.05,
+                        help='Datagrams reordered in the datagram benchmark '
+                        '(0 to 1).')
+    parser.add_argument('--startup-runs', type=int, default=5,
+                        help='Interpreters started per startup benchmark.')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='Save the results as JSON.')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Compare against previously saved results.')
+    return parser.parse_args(args)
+
+
+class LossySocket:
+    # Wraps a datagram socket to drop and reorder what's sent through it. A
+    # reordered datagram is held back and sent after the next one.
+    def __init__(self, sock, loss=0.0, reorder=0.0, seed=0):
+        self._socket = sock
+        self._loss = loss
+        self._reorder = reorder
+        self._random = random.Random(seed)
+        self._held = None
+        self.sent = 0
+        self.dropped = 0
+        self.reordered = 0
+
+    def sendto(self, data, address):
+        self.sent += 1
+        if self._random.random() < self._loss:
+            self.dropped += 1
+            return
+        if self._held is None and self._random.random() < self._reorder:
+            self._held = (data, address)
+            self.reordered += 1
+            return
+        self._socket.sendto(data, address)
+        self.flush()
+
+    def flush(self):
+        if self._held is not None:
+            self._socket.sendto(*self._held)
+            self._held = None
+
+    def __getattr__(self, name):
+        return getattr(self._socket, name)
+
+
+def percentile(sorted_samples, p):
+    if not sorted_samples:
+        return 0.0
+    idx = min(len(sorted_samples) - 1,
+              int(math.ceil(p / 100 * len(sorted_samples))) - 1)
+    return sorted_samples[max(idx, 0)]
+
+
+def summarize(samples, events, wall, cpu):
+    samples = sorted(samples)
+    return {'events': events,
+            'operations': len(samples),
+            'events_per_sec': events / wall if wall else 0.0,
+            'p50_us': percentile(samples, 50) * 1e6,
+            'p99_us': percentile(samples, 99) * 1e6,
+            'p99.9_us': percentile(samples, 99.9) * 1e6,
+            'cpu_us_per_event': cpu / events * 1e6 if events else 0.0}
+
+
+def measure(items, fn, events_per_item=1):
+    samples = []
+    events = 0
+    cpu0 = time.process_time()
+    t0 = time.perf_counter()
+    for item in items:
+        start = time.perf_counter()
+        fn(item)
+        samples.append(time.perf_counter() - start)
+        events += events_per_item(item) if callable(events_per_item) \
+            else events_per_item
+    wall = time.perf_counter() - t0
+    cpu = time.process_time() - cpu0
+    return summarize(samples, events, wall, cpu)
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.keys = generate_keys()
+        self._tmp = tempfile.TemporaryDirectory()
+        self.public_key_file = os.path.join(self._tmp.name, 'bench.pub')
+        with open(self.public_key_file, 'wb') as f:
+            f.write(serialize_public_key(self.keys.public))
+        self.private_key_file = os.path.join(self._tmp.name, 'bench')
+        with open(self.private_key_file, 'wb') as f:
+            f.write(serialize_private_key(self.keys.private))
+        reports = args.events // 2
+        self.mouse_reads = mouse_trace(
+                            reports, reports_per_read=args.reports_per_read)
+        self.keyboard_reads = keyboard_trace(args.events // 6)
+        self.mouse = FakeInputDevice('bench mouse', MOUSE_CAPABILITIES)
+        self.keyboard = FakeInputDevice('bench keyboard',
+                                        KEYBOARD_CAPABILITIES)
+
+    def close(self):
+        self._tmp.cleanup()
+
+    def _server(self, encryption='session', local=True):
+        server = KybonetServer(encryption=encryption)
+        if local:
+            server.add_subscriber('local')
+        else:
+            server.add_subscriber('bench', id_file=self.public_key_file)
+        server.switch(0)
+        return server
+
+    def run_parse(self):
+        # Local subscriber: from_event, filtering and merging, nothing sent.
+        server = self._server()
+        return {
+            'parse_mouse': measure(
+                self.mouse_reads,
+                lambda r: server.parse_events(self.mouse, r), len),
+            'parse_keyboard': measure(
+                self.keyboard_reads,
+                lambda r: server.parse_events(self.keyboard, r), len)}
+
+    def run_merge(self):
+        # Filtering into the batch and merging the motion in it.
+        profile = DeviceProfile.from_capabilities(MOUSE_CAPABILITIES)
+        batch = EventBatch()
+        return {'merge_mouse': measure(
+                    self.mouse_reads,
+                    lambda r: profile.load(batch, r).merge_motion(), len)}
+
+    def run_coalesce(self):
+        # Messages per second left from the 1000 Hz trace, replayed on its
+        # own clock, for several coalescing windows.
+        results = {}
+        reads = [EventBatch.from_events([e for e in r
+                                         if e.type != ecodes.EV_SYN])
+                 for r in self.mouse_reads]
+        read_interval = self.args.reports_per_read / 1000
+        duration = len(reads) * read_interval
+        for window_ms in (2, 4, 8):
+            server = self._server()
+            server._coalescer = MotionCoalescer(window=window_ms / 1000,
+                                                adaptive=False)
+            messages = []
+
+            def step(item):
+                idx, read = item
+                events = server.coalesce(read, now=idx * read_interval)
+                if events:
+                    messages.append(len(events))
+
+            result = measure(enumerate(reads), step, lambda i: len(i[1]))
+            result['messages_per_sec'] = len(messages) / duration
+            results['coalesce_{}ms'.format(window_ms)] = result
+        return results
+
+    def run_crypto(self):
+        n = max(self.args.events // 100, 10)
+        payload = pack_payload([PseudoEvent(ecodes.EV_REL, ecodes.REL_X, 1,
+                                            0.0)] * 4)
+        public, private = self.keys.public, self.keys.private
+        rsa_messages = [encrypt(payload, public) for _ in range(n)]
+        session = SessionKey.generate()
+        receiver = SessionKey.load(session.export())
+        counters = list(range(self.args.events))
+        sealed = [session.seal(c, payload) for c in counters]
+        return {
+            'rsa_encrypt': measure(range(n),
+                                   lambda _: encrypt(payload, public)),
+            'rsa_decrypt': measure(rsa_messages,
+                                   lambda m: decrypt(m, private)),
+            'session_seal': measure(counters,
+                                    lambda c: session.seal(c, payload)),
+            'session_open': measure(counters,
+                                    lambda c: receiver.open(c, sealed[c]))}
+
+    def run_serialize(self):
+        frames = [[PseudoEvent(e.type, e.code, e.value, 0.0) for e in r
+                   if e.type != ecodes.EV_SYN] for r in self.mouse_reads]
+        batches = [EventBatch.from_events(f) for f in frames]
+        packed = [pack_payload(f) for f in frames]
+        events = [e for f in frames for e in f]
+        packed_json = [pack_json_payload(e) for e in events]
+        return {
+            'pack_frame': measure(frames, pack_payload, len),
+            'pack_batch': measure(batches, pack_batch, len),
+            'unpack_frame': measure(packed, unpack_payload,
+                                    lambda p: len(unpack_payload(p))),
+            'pack_json': measure(events, pack_json_payload),
+            'unpack_json': measure(packed_json, unpack_payload)}
+
+    def run_inject(self):
+        # Packing frames as input_event structs and writing them (to
+        # /dev/null): one write() per frame, and per backlog of 16 frames.
+        frames = [[PseudoEvent(e.type, e.code, e.value, 0.0) for e in r
+                   if e.type != ecodes.EV_SYN] for r in self.mouse_reads]
+        backlogs = [frames[i:i + 16] for i in range(0, len(frames), 16)]
+        results = {}
+        device = NullDevice()
+        results['inject_frame'] = measure(frames, device.write_events, len)
+        results['inject_frame']['writes'] = device.writes
+        device.close()
+        device = NullDevice()
+        results['inject_backlog'] = measure(
+                    backlogs, device.write_frames,
+                    lambda backlog: sum(map(len, backlog)))
+        results['inject_backlog']['writes'] = device.writes
+        device.close()
+        return results
+
+    def run_priority(self):
+        # Key latency behind a mouse flood: each keyboard read comes after a
+        # burst of mouse reads still waiting in the send queue. Measured from
+        # the key read until its message is sent, with the queue in order
+        # (fifo) and by priority (lanes).
+        burst = 16
+        key_reads = self.keyboard_reads[:max(self.args.events // 40, 50)]
+        mouse_reads = self.mouse_reads
+        results = {}
+        for name, priority in (('fifo', False), ('lanes', True)):
+            context = zmq.Context()
+            server = KybonetServer(priority=priority)
+            server.add_subscriber('bench', id_file=self.public_key_file)
+            server.bind('inproc://kybonet-bench-priority', context=context)
+            server.switch(0)
+            sent = []
+
+            def publish(*item):
+                server._publish(*item)
+                sent.append((time.perf_counter(), item[1]))
+
+            # Never started: drained by this thread after each key read.
+            server._send_stage = Stage('send', publish, maxsize=4 * burst,
+                                       lanes=priority)
+            samples = []
+            cpu0 = time.process_time()
+            t0 = time.perf_counter()
+            for i, key_read in enumerate(key_reads):
+                for j in range(i * burst, (i + 1) * burst):
+                    server.feed(self.mouse, mouse_reads[j % len(mouse_reads)])
+                start = time.perf_counter()
+                server.feed(self.keyboard, key_read)
+                del sent[:]
+                server._send_stage.drain()
+                for done, payload in sent:
+                    if any(e.etype == ecodes.EV_KEY and
+                           e.code < ecodes.BTN_MISC
+                           for e in unpack_payload(payload)):
+                        samples.append(done - start)
+                        break
+            wall = time.perf_counter() - t0
+            cpu = time.process_time() - cpu0
+            results['priority_' + name] = summarize(samples, len(samples),
+                                                    wall, cpu)
+            context.destroy(linger=0)
+        return results
+
+    def run_mirror(self):
+        # Cost of sending each keyboard read to a group (mirror mode), for
+        # several group sizes. Nobody is connected: zmq drops the messages.
+        key_reads = self.keyboard_reads[:max(self.args.events // 40, 50)]
+        results = {}
+        for encryption in ('session', 'rsa'):
+            for size in (1, 4, 16):
+                context = zmq.Context()
+                server = KybonetServer(encryption=encryption)
+                for i in range(size):
+                    server.add_subscriber('bench{}'.format(i),
+                                          id_file=self.public_key_file)
+                server.add_group('bench', ['bench{}'.format(i)
+                                           for i in range(size)])
+                server.bind('inproc://kybonet-bench-mirror',
+                            context=context)
+                server.switch_group(0)
+                name = 'mirror_{}_{}'.format(encryption, size)
+                results[name] = measure(
+                    key_reads, lambda r: server.feed(self.keyboard, r), len)
+                server.teardown()
+                context.destroy(linger=0)
+        return results
+
+    def run_loop(self):
+        # Full server -> client path in a single thread: parse, encrypt,
+        # send, receive, decrypt, decode and inject into a fake sink.
+        args = self.args
+        context = zmq.Context()
+        if args.transport == 'inproc':
+            endpoint = 'inproc://kybonet-bench'
+            bind_endpoint = endpoint
+        else:
+            bind_endpoint = 'tcp://127.0.0.1:*'
+            endpoint = None
+        server = self._server(encryption=args.encryption, local=False)
+        server.bind(bind_endpoint, context=context)
+        if endpoint is None:
+            endpoint = server._socket.getsockopt_string(zmq.LAST_ENDPOINT)
+        client = KybonetClient(encryption=args.encryption)
+        topic = b'' if args.encryption == 'rsa' else \
+            fingerprint(self.keys.public)
+        client.connect_endpoint(endpoint, topic=topic, context=context)
+        sink = MemorySink(keep=0)
+        key = self.keys.private
+
+        def drain(timeout=0):
+            while client.poll(timeout):
+                events = client.receive(key)
+                if events:
+                    sink.write_events(events)
+                timeout = 0
+
+        # Wait for the subscription to reach the publisher.
+        deadline = time.monotonic() + 5
+        while sink.events == 0 and time.monotonic() < deadline:
+            server.parse_events(self.keyboard, self.keyboard_reads[0])
+            server.parse_events(self.keyboard, self.keyboard_reads[1])
+            drain(timeout=10)
+
+        if args.encryption == 'rsa':
+            reads = self.mouse_reads[:max(len(self.mouse_reads) // 20, 10)]
+        else:
+            reads = self.mouse_reads
+        sink.events = 0
+        samples = []
+        cpu0 = time.process_time()
+        t0 = time.perf_counter()
+        for read in reads:
+            start = time.perf_counter()
+            server.parse_events(self.mouse, read)
+            drain()
+            samples.append(time.perf_counter() - start)
+        wall = time.perf_counter() - t0
+        cpu = time.process_time() - cpu0
+        context.destroy(linger=0)
+        name = 'loop_{}_{}'.format(args.encryption, args.transport)
+        return {name: summarize(samples, sink.events, wall, cpu)}
+
+    def run_datagram(self):
+        # Full loop with motion sent as datagrams through a lossy socket:
+        # motion may be lost or dropped as late, clicks must all arrive and
+        # in order.
+        args = self.args
+        context = zmq.Context()
+        server = self._server(local=False)
+        server.bind('tcp://127.0.0.1:*', context=context)
+        server.bind_datagram(0, host='127.0.0.1')
+        port = server._datagram.getsockname()[1]
+        lossy = LossySocket(server._datagram, loss=args.loss,
+                            reorder=args.reorder)
+        server._datagram = lossy
+        client = KybonetClient()
+        client.connect_endpoint(
+                    server._socket.getsockopt_string(zmq.LAST_ENDPOINT),
+                    topic=fingerprint(self.keys.public), context=context)
+        client.connect_datagram('127.0.0.1', port)
+        key = self.keys.private
+        received = []
+
+        def drain(timeout=0):
+            while client.poll(timeout):
+                for events, _, _, _ in client.receive_all(key):
+                    received.extend(events)
+                timeout = 0
+
+        deadline = time.monotonic() + 5
+        while server.current_sub['address'] is None and \
+                time.monotonic() < deadline:
+            server.maintenance()
+            server.process_requests()
+            client.ping()
+            drain(timeout=10)
+
+        received.clear()
+        samples = []
+        cpu0 = time.process_time()
+        t0 = time.perf_counter()
+        for read in self.mouse_reads:
+            start = time.perf_counter()
+            server.parse_events(self.mouse, read)
+            drain()
+            samples.append(time.perf_counter() - start)
+        lossy.flush()
+        drain(timeout=50)
+        wall = time.perf_counter() - t0
+        cpu = time.process_time() - cpu0
+        context.destroy(linger=0)
+
+        clicks = [e.value for r in self.mouse_reads for e in r
+                  if e.type == ecodes.EV_KEY]
+        result = summarize(samples, len(received), wall, cpu)
+        result.update({
+            'datagrams_sent': lossy.sent,
+            'datagrams_dropped': lossy.dropped,
+            'datagrams_reordered': lossy.reordered,
+            'datagrams_received': client.datagrams,
+            'datagrams_late': client.late_datagrams,
+            'clicks_in_order': clicks == [e.value for e in received
+                                          if e.etype == ecodes.EV_KEY]})
+        return {'loop_datagram': result}
+
+    def run_startup(self):
+        # Fresh interpreters: import time of each entry point, and time from
+        # spawning a client until it decodes its first event (interpreter
+        # start, imports, key loading, connection and session key).
+        runs = self.args.startup_runs
+        env = dict(os.environ)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join(
+                                filter(None, [root, env.get('PYTHONPATH')]))
+        results = {}
+        for name, module in sorted(ENTRY_POINTS.items()):
+            cpu0 = _children_cpu()
+            samples = [float(subprocess.check_output(
+                            [sys.executable, '-c', _import_script.format(
+                                module)], env=env))
+                       for _ in range(runs)]
+            results['startup_import_' + name] = summarize(
+                samples, runs, sum(samples), _children_cpu() - cpu0)
+
+        context = zmq.Context()
+        server = self._server(local=False)
+        server.bind('tcp://127.0.0.1:*', context=context)
+        endpoint = server._socket.getsockopt_string(zmq.LAST_ENDPOINT)
+        samples = []
+        cpu0 = _children_cpu()
+        try:
+            for _ in range(runs):
+                samples.append(self._first_event(server, endpoint, env))
+        finally:
+            context.destroy(linger=0)
+        results['startup_first_event'] = summarize(
+                    samples, runs, sum(samples), _children_cpu() - cpu0)
+        return results
+
+    def _first_event(self, server, endpoint, env, timeout=10):
+        spawned = time.time()
+        child = subprocess.Popen(
+                    [sys.executable, '-c', _first_event_script, repr(spawned),
+                     self.private_key_file, endpoint],
+                    env=env, stdout=subprocess.PIPE)
+        deadline = time.monotonic() + timeout
+        while child.poll() is None:
+            if time.monotonic() > deadline:
+                child.kill()
+                child.wait()
+                raise RuntimeError('No event received by the client.')
+            server.process_requests()
+            server.maintenance()
+            server.parse_events(self.keyboard, self.keyboard_reads[0])
+            server.parse_events(self.keyboard, self.keyboard_reads[1])
+            time.sleep(0.001)
+        return float(child.stdout.read())
+
+
+def _children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def load_results(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def compare(results, baseline):
+    lines = []
+    fmt = '{:<24} {:>12} {:>12} {:>8}'
+    lines.append(fmt.format('benchmark', 'events/s', 'baseline', 'ratio'))
+    for name, r in sorted(results['results'].items()):
+        b = baseline['results'].get(name)
+        if b is None or not b['events_per_sec']:
+            continue
+        ratio = r['events_per_sec'] / b['events_per_sec']
+        lines.append(fmt.format(name, '{:.0f}'.format(r['events_per_sec']),
+                                '{:.0f}'.format(b['events_per_sec']),
+                                '{:.2f}'.format(ratio)))
+    return '\n'.join(lines)
+
+
+def report(results):
+    lines = []
+    fmt = '{:<24} {:>12} {:>10} {:>10} {:>10} {:>10}'
+    lines.append(fmt.format('benchmark', 'events/s', 'p50 us', 'p99 us',
+                            'p99.9 us', 'cpu us/ev'))
+    for name, r in sorted(results['results'].items()):
+        lines.append(fmt.format(name,
+                                '{:.0f}'.format(r['events_per_sec']),
+                                '{:.1f}'.format(r['p50_us']),
+                                '{:.1f}'.format(r['p99_us']),
+                                '{:.1f}'.format(r['p99.9_us']),
+                                '{:.2f}'.format(r['cpu_us_per_event'])))
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    args = parse_args(args=args)
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            print('Unknown benchmark: "{}"'.format(name))
+            return 1
+    logging.basicConfig(level=logging.WARNING,
+                        format='%(levelname)s - %(message)s')
+
+    bench = Bench(args)
+    results = {'meta': {'python': platform.python_version(),
+                        'platform': platform.platform(),
+                        'time': time.time(),
+                        'args': vars(args)},
+               'results': {}}
+    try:
+        for name in args.benchmarks:
+            results['results'].update(getattr(bench, 'run_' + name)())
+    finally:
+        bench.close()
+
+    print(report(results))
+    if args.compare:
+        print()
+        print(compare(results, load_results(args.compare)))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Results saved in "{}".'.format(args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
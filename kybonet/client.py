@@ -1,23 +1,75 @@
 import argparse
-import json
 import zmq
 import os
+import queue
+import signal
+import socket
+import threading
+import sys
+import time
 import logging
-from .crypto import import_private_key, decrypt
-from .input_devices import PseudoEvent, FakeDevice
+from .backends import SINKS, open_sink
+from .crypto import import_private_key, decrypt, fingerprint
+from .input_devices import PseudoEvent, SourceDevice, DEVICE_CAPABILITIES, \
+                           merge_backlog
+from .pipeline import Stage
+from .protocol import ENCRYPTION_MODES, MSG_SESSION_KEY, MSG_EVENT, \
+                      MSG_DATAGRAM, MSG_KEY_STATE, MSG_PONG, message_kind, \
+                      unpack_session_key, unpack_event, unpack_payload, \
+                      unpack_key_state, \
+                      unpack_trace, unpack_pong, pack_ping, pack_hello, \
+                      split_datagram, ProtocolError, LateMessage, \
+                      UnknownSession, UnsupportedVersion
+from .stats import LatencyTracer, LatencyHistogram
 
 logger = logging.getLogger(__name__)
 
 
 def parse_args(args=None):
     parser = argparse.ArgumentParser()
-    parser.add_argument('ip', type=str, help='ip')
+    parser.add_argument('ip', type=str, nargs='?', default=None, help='ip')
     parser.add_argument('-p', '--port', type=int, default=5555, help='port')
+    parser.add_argument('--server', type=str, nargs=2, action='append',
+                        default=[], metavar=('IP[:PORT]', 'KEY'),
+                        help='Also follow this server, with this private '
+                        'key (can be repeated). The events of every server '
+                        'go to the same virtual device.')
+    parser.add_argument('-u', '--udp-port', type=int, default=None,
+                        help='Receive mouse motion as UDP datagrams from '
+                        'this server port (the server must use the same '
+                        '--udp-port).')
     parser.add_argument('-i', '--id-rsa', type=str, default=None,
-                        required=True, help='Private key path (generate one '
-                        'with kybonet-keygen)')
+                        help='Private key path (generate one with '
+                        'kybonet-keygen), required with ip.')
     parser.add_argument('-sim', '--simulate', action='store_true',
-                        help='Simulate, don\'t press/release any key.')
+                        help='Simulate, don\'t press/release any key (the '
+                        'events are written to /dev/null instead, to measure '
+                        'the injection). Same as --sink null.')
+    parser.add_argument('--sink', type=str, default='uinput',
+                        choices=SINKS,
+                        help='Where the events go: the virtual device '
+                        '(uinput, default), /dev/null (null) or memory, '
+                        'keeping the last ones and the keys held (memory). '
+                        'Only uinput needs /dev/uinput.')
+    parser.add_argument('--capabilities', type=str, default='full',
+                        choices=sorted(DEVICE_CAPABILITIES),
+                        help='Keys of the virtual device: every known key '
+                        '(full) or a regular keyboard and mouse buttons '
+                        '(basic, created faster). Default: full.')
+    parser.add_argument('-e', '--encryption', type=str, default='session',
+                        choices=ENCRYPTION_MODES,
+                        help='Encryption mode, must match the server '
+                        '(default: session).')
+    parser.add_argument('-s', '--stats-interval', type=float, default=0,
+                        help='Log latency stats every N seconds (they are '
+                        'also logged on SIGUSR1).')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Receive, decrypt and inject in separate '
+                        'threads. Motion that piles up while injecting is '
+                        'merged.')
+    parser.add_argument('--queue-size', type=int, default=1024,
+                        help='Size of the queues between pipeline stages '
+                        '(default: 1024).')
     verbosity = parser.add_mutually_exclusive_group(required=False)
     verbosity.add_argument('-q', '--quiet', action='store_true',
                            help='Reduce output messages.')
@@ -27,35 +79,531 @@ def parse_args(args=None):
 
 
 class KybonetClient:
-    def __init__(self):
+    # Previous session key is kept so in-flight events survive a rekey.
+    max_sessions = 2
+    # Seconds between pings used to estimate the server clock offset.
+    ping_interval = 2.0
+
+    def __init__(self, encryption='session'):
+        assert encryption in ENCRYPTION_MODES, \
+            'Unknown encryption mode: "{}"'.format(encryption)
         # zmq
         self._context = None
         self._socket = None
+        # datagram transport (motion only)
+        self._datagram = None
+        self._poller = None
+        self._last_hello = 0
+        self.datagrams = 0
+        self.late_datagrams = 0
+        # key state snapshots received, and keys released by them
+        self.key_states = 0
+        self.stuck_keys = 0
+        # stats
+        self.messages_received = 0
+        self.bytes_received = 0
+        # crypto
+        self._encryption = encryption
+        self._sessions = {}
+        # _hello (receive thread) reads them while the decrypt thread adds.
+        self._sessions_lock = threading.Lock()
+        # latency
+        self._topic = b''
+        self._last_ping = 0
+        self.tracer = LatencyTracer()
+        # where the events are injected (set by run/run_pipelined)
+        self._device = None
+        # pipeline
+        self._stages = []
+        self._inject_queue = None
+        self.wakeups = 0
+        self.messages = 0
+        self.max_drained = 0
+        self.injected_frames = 0
+        self.merged_frames = 0
+
+    def connect(self, ip, port, topic=b''):
+        self.connect_endpoint("tcp://{}:{}".format(ip, port), topic=topic)
+
+    def connect_endpoint(self, endpoint, topic=b'', context=None):
+        if context is None:
+            context = zmq.Context()
+            # ZMQ Socket Options: http://api.zeromq.org/4-2:zmq-setsockopt
+            # Send ZMTP heartbeats every 5000 ms.
+            context.setsockopt(zmq.HEARTBEAT_IVL, 5000)
+        self._context = context
+        # XSUB instead of SUB, so pings can be sent upstream to the server.
+        self._socket = self._context.socket(zmq.XSUB)
+        self._socket.connect(endpoint)
+        self._socket.send(b'\x01' + topic)
+        self._topic = topic
+
+    def connect_datagram(self, ip, port):
+        # Motion is also received as datagrams. The address is registered
+        # with a hello, sent as soon as there's a session key and then
+        # every ping_interval.
+        assert self._encryption == 'session', \
+            'Datagrams require session encryption'
+        self._datagram = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._datagram.connect((ip, port))
+        self._datagram.setblocking(False)
+        self._poller = zmq.Poller()
+        self._poller.register(self._socket, zmq.POLLIN)
+        self._poller.register(self._datagram, zmq.POLLIN)
 
-    def connect(self, ip, port):
-        self._context = zmq.Context()
-        # ZMQ Socket Options: http://api.zeromq.org/4-2:zmq-setsockopt
-        # Send ZMTP heartbeats every 5000 ms.
-        self._context.setsockopt(zmq.HEARTBEAT_IVL, 5000)
-        self._socket = self._context.socket(zmq.SUB)
-        self._socket.connect("tcp://{}:{}".format(ip, port))
-        self._socket.subscribe('')
-
-    def run(self, key, simulate=False):
-        device = FakeDevice(name='my-fake-device')
+    def run(self, key, simulate=False, device=None, stats_interval=0):
+        device = self._open_device(device, simulate)
+        report_requested = []
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1,
+                          lambda signum, frame: report_requested.append(True))
+        last_report = time.monotonic()
         while True:
-            rcv = self._socket.recv()
+            self.ping()
+            if report_requested or (stats_interval and
+                                    time.monotonic() - last_report >
+                                    stats_interval):
+                del report_requested[:]
+                self.report_stats()
+                last_report = time.monotonic()
+            if not self.poll(self.ping_interval * 1000):
+                continue
+            for events, trace, received, decrypted in self.receive_all(key):
+                if not events:
+                    continue
+                device.write_events(events)
+                self.tracer.record(events, trace, received, decrypted,
+                                   time.time())
+
+    def run_pipelined(self, key, simulate=False, device=None,
+                      stats_interval=0, queue_size=1024):
+        # receive (own thread, the only one using the socket) -> decrypt
+        # (Stage) -> inject (this thread). Each stage drains whatever is
+        # queued before waiting again, so a burst is handled as one batch.
+        device = self._open_device(device, simulate)
+        self._inject_queue = queue.Queue(maxsize=queue_size)
+        decrypt_stage = Stage('decrypt', self._decrypt_stage,
+                              maxsize=queue_size)
+        self._stages = [decrypt_stage]
+        receiver = threading.Thread(target=self._receive_loop,
+                                    args=(decrypt_stage, key),
+                                    name='receive', daemon=True)
+        report_requested = []
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1,
+                          lambda signum, frame: report_requested.append(True))
+        decrypt_stage.start()
+        receiver.start()
+        last_report = time.monotonic()
+        try:
+            while True:
+                if report_requested or (stats_interval and
+                                        time.monotonic() - last_report >
+                                        stats_interval):
+                    del report_requested[:]
+                    self.report_stats()
+                    last_report = time.monotonic()
+                try:
+                    item = self._inject_queue.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                self._inject(self._drain_inject_queue(item), device)
+        finally:
+            decrypt_stage.stop()
+
+    def _open_device(self, device, simulate):
+        # No uinput device is created when simulating.
+        if device is None:
+            device = open_sink('null' if simulate else 'uinput')
+        self._device = device
+        return device
+
+    def report_stats(self):
+        lines = self.tracer.report()
+        if not lines:
+            logger.info('Latency: no events received yet.')
+        for line in lines:
+            logger.info('Latency: {}'.format(line))
+        for line in self.pipeline_stats():
+            logger.info('Pipeline: {}'.format(line))
+        if hasattr(self._device, 'stats'):
+            logger.info('Injection: {}'.format(self._device.stats()))
+        if self.key_states:
+            logger.info('Key states: received={} keys released={}'.format(
+                            self.key_states, self.stuck_keys))
+        if self._datagram is not None:
+            logger.info('Datagrams: received={} late={}'.format(
+                            self.datagrams, self.late_datagrams))
+
+    def pipeline_stats(self):
+        if not self._stages:
+            return []
+        lines = ['receive: wakeups={} messages={} max_drained={}'.format(
+                        self.wakeups, self.messages, self.max_drained)]
+        lines.extend(stage.stats() for stage in self._stages)
+        lines.append('inject: depth={} frames={} merged={}'.format(
+                        self._inject_queue.qsize(), self.injected_frames,
+                        self.merged_frames))
+        return lines
+
+    def poll(self, timeout=None):
+        if self._poller is not None:
+            return bool(self._poller.poll(timeout))
+        return bool(self._socket.poll(timeout))
+
+    def receive(self, key):
+        # Blocks until something is received.
+        self.poll()
+        return [e for events, _, _, _ in self.receive_all(key)
+                for e in events]
+
+    @property
+    def socket(self):
+        return self._socket
+
+    @property
+    def has_session(self):
+        return bool(self._sessions)
+
+    def receive_all(self, key):
+        # Without blocking: the datagrams waiting and at most one message
+        # from the reliable channel, as (events, trace, time received, time
+        # decrypted) tuples for the tracer. Datagrams first: if a message
+        # from the reliable channel is also waiting, it may have been sent
+        # after them.
+        results = [self._process(message, trace, received, key)
+                   for message, trace, received in self._recv_datagrams()]
+        if self._socket.poll(0):
+            results.append(self._receive(key))
+        return results
+
+    def _recv_datagrams(self):
+        received = []
+        if self._datagram is None:
+            return received
+        while True:
+            try:
+                data = self._datagram.recv(2048)
+            except (BlockingIOError, InterruptedError):
+                return received
+            except OSError as e:
+                # e.g. ECONNREFUSED after a hello to a closed port.
+                logger.debug('Datagram socket: {}'.format(e))
+                return received
             try:
-                decrypted = decrypt(message=rcv, private_key=key)
-            except ValueError:
-                txt = 'Unable to decode message... May be it wasn\'t for you?'
-                logger.debug(txt)
+                message, trace = split_datagram(data)
+            except ProtocolError:
+                continue
+            self.datagrams += 1
+            self.messages_received += 1
+            self.bytes_received += len(data)
+            received.append((message, trace, time.time()))
+
+    def ping(self):
+        # Pings need a topic for the answer, so not available in rsa mode.
+        if self._encryption == 'rsa':
+            return
+        self._hello()
+        now = time.monotonic()
+        if now - self._last_ping < self.ping_interval:
+            return
+        self._last_ping = now
+        self._socket.send(pack_ping(self._topic, time.time()))
+
+    def _hello(self):
+        if self._datagram is None or not self._sessions:
+            return
+        now = time.monotonic()
+        if now - self._last_hello < self.ping_interval:
+            return
+        self._last_hello = now
+        with self._sessions_lock:
+            sessions = list(self._sessions.values())
+        session = max(sessions, key=lambda s: s.created)
+        try:
+            self._datagram.send(pack_hello(self._topic, session))
+        except OSError as e:
+            logger.debug('Unable to send hello: {}'.format(e))
+
+    def _receive_loop(self, stage, key):
+        while True:
+            self.ping()
+            if not self.poll(self.ping_interval * 1000):
                 continue
-            message = decrypted.decode('utf-8')
-            decoded_event = json.loads(message)
-            event = PseudoEvent(**decoded_event)
-            if not simulate:
-                device.write_event(event)
+            self.wakeups += 1
+            drained = 0
+            for message, trace, received in self._recv_datagrams():
+                stage.put((message, trace, received, key))
+                drained += 1
+            while True:
+                try:
+                    frames = self._socket.recv_multipart(zmq.NOBLOCK,
+                                                         copy=False)
+                except zmq.Again:
+                    break
+                message, trace = self._split(frames)
+                stage.put((message, trace, time.time(), key))
+                drained += 1
+            self.messages += drained
+            self.max_drained = max(self.max_drained, drained)
+
+    def _decrypt_stage(self, message, trace, received, key):
+        try:
+            item = self._process(message, trace, received, key)
+        except UnsupportedVersion as e:
+            # Raised again in the injector thread, to stop the client.
+            item = e
+        self._inject_queue.put(item)
+
+    def _drain_inject_queue(self, item):
+        items = [item]
+        while True:
+            try:
+                items.append(self._inject_queue.get_nowait())
+            except queue.Empty:
+                break
+        for item in items:
+            if isinstance(item, UnsupportedVersion):
+                raise item
+        return [item for item in items if item[0]]
+
+    def _inject(self, items, device):
+        if not items:
+            return
+        frames = [events for events, _, _, _ in items]
+        if len(frames) > 1:
+            frames = merge_backlog(frames)
+        self.injected_frames += len(frames)
+        self.merged_frames += len(items) - len(frames)
+        device.write_frames(frames)
+        injected = time.time()
+        for events, trace, received, decrypted in items:
+            self.tracer.record(events, trace, received, decrypted, injected)
+
+    def _receive(self, key):
+        # Returns the events plus the data needed to trace their latency:
+        # server stage stamps, time received and time decrypted.
+        rcv, trace = self._recv()
+        return self._process(rcv, trace, time.time(), key)
+
+    def _process(self, rcv, trace, received, key):
+        try:
+            decrypted = self._decrypt(rcv, key, received)
+        except UnsupportedVersion:
+            raise
+        except UnknownSession as e:
+            logger.debug('{}. Waiting for the session key...'.format(e))
+            return [], None, received, received
+        except LateMessage as e:
+            self.late_datagrams += 1
+            logger.debug(e)
+            return [], None, received, received
+        except ValueError:
+            txt = 'Unable to decode message... May be it wasn\'t for you?'
+            logger.debug(txt)
+            return [], None, received, received
+        if decrypted is None:
+            return [], None, received, received
+        try:
+            if self._encryption == 'session' and \
+                    message_kind(rcv) == MSG_KEY_STATE:
+                events = self._release_stuck_keys(unpack_key_state(decrypted))
+            else:
+                events = unpack_payload(decrypted)
+        except UnsupportedVersion:
+            raise
+        except ProtocolError as e:
+            logger.warning('Invalid message: {}'.format(e))
+            return [], None, received, received
+        return events, unpack_trace(trace), received, time.time()
+
+    def _release_stuck_keys(self, pressed):
+        # Releases for the keys held in the virtual device that aren't held
+        # in the server. In the pipeline this runs before the frames queued
+        # for injection are written: a release among them may be repeated,
+        # which is harmless, and a press among them is in `pressed`.
+        self.key_states += 1
+        held = getattr(self._device, 'pressed', None)
+        if not held:
+            return []
+        events = [PseudoEvent.KeyRelease(code)
+                  for code in held.copy() - pressed]
+        if events:
+            self.stuck_keys += len(events)
+            logger.debug('Key state: releasing {} keys'.format(len(events)))
+        return events
+
+    def _recv(self):
+        return self._split(self._socket.recv_multipart())
+
+    def _split(self, frames):
+        # Frames received with copy=False are read through their buffer,
+        # without copying them into bytes.
+        frames = [f.buffer if isinstance(f, zmq.Frame) else f
+                  for f in frames]
+        self.messages_received += 1
+        self.bytes_received += sum(len(f) for f in frames)
+        if self._encryption == 'rsa':
+            return frames[0], None
+        if len(frames) == 3:
+            _, message, trace = frames
+            return message, trace
+        return frames[1], None
+
+    def _decrypt(self, message, key, received=None):
+        if self._encryption == 'rsa':
+            return decrypt(message=bytes(message), private_key=key)
+        kind = message_kind(message)
+        if kind in (MSG_EVENT, MSG_DATAGRAM, MSG_KEY_STATE):
+            return unpack_event(message, self._sessions)
+        if kind == MSG_PONG:
+            client_time, server_time = unpack_pong(message)
+            if received is None:
+                received = time.time()
+            self.tracer.clock.add(client_time, server_time, received)
+            return None
+        if kind == MSG_SESSION_KEY:
+            self._add_session(unpack_session_key(message, key))
+            return None
+        raise ValueError('Unknown message kind: {}'.format(kind))
+
+    def _add_session(self, session):
+        if session.key_id in self._sessions:
+            return
+        logger.debug('New session key {:08x}'.format(session.key_id))
+        with self._sessions_lock:
+            self._sessions[session.key_id] = session
+            while len(self._sessions) > self.max_sessions:
+                oldest = min(self._sessions.values(),
+                             key=lambda s: s.created)
+                del self._sessions[oldest.key_id]
+        # Register the datagram address with the new key right away.
+        self._last_hello = 0
+
+
+class MultiClient:
+    # Follows several servers (e.g. two desks) with a single poller: one
+    # KybonetClient per server, each with its own key, all injecting into
+    # the same virtual device. Each one writes through a SourceDevice, so
+    # the key state of a server only releases the keys it pressed.
+    def __init__(self, encryption='session'):
+        assert encryption in ENCRYPTION_MODES, \
+            'Unknown encryption mode: "{}"'.format(encryption)
+        self._encryption = encryption
+        self._context = None
+        self._poller = zmq.Poller()
+        self._sources = []
+        # socket (zmq or datagram) -> source
+        self._owners = {}
+        self._device = None
+
+    @property
+    def sources(self):
+        return self._sources
+
+    def connect(self, ip, port, key, udp_port=None, name=None):
+        self.connect_endpoint('tcp://{}:{}'.format(ip, port), key,
+                              name=name or '{}:{}'.format(ip, port))
+        if udp_port:
+            source = self._sources[-1]
+            source['client'].connect_datagram(ip=ip, port=udp_port)
+            self._register(source['client']._datagram, source)
+
+    def connect_endpoint(self, endpoint, key, name=None, context=None):
+        if context is None:
+            if self._context is None:
+                self._context = zmq.Context()
+                # Send ZMTP heartbeats every 5000 ms.
+                self._context.setsockopt(zmq.HEARTBEAT_IVL, 5000)
+            context = self._context
+        client = KybonetClient(encryption=self._encryption)
+        topic = b'' if self._encryption == 'rsa' else \
+            fingerprint(key.public_key())
+        client.connect_endpoint(endpoint, topic=topic, context=context)
+        # receive: time to receive and decrypt what was ready on a wakeup
+        source = {'name': name or endpoint, 'client': client, 'key': key,
+                  'receive': LatencyHistogram()}
+        self._sources.append(source)
+        self._register(client.socket, source)
+        return source
+
+    def _register(self, sock, source):
+        self._poller.register(sock, zmq.POLLIN)
+        self._owners[sock] = source
+
+    def open_device(self, device, simulate=False):
+        if device is None:
+            device = open_sink('null' if simulate else 'uinput')
+        self._device = device
+        views = []
+        for source in self._sources:
+            views.append(SourceDevice(device, views))
+            source['client']._open_device(views[-1], simulate)
+        return device
+
+    def run(self, simulate=False, device=None, stats_interval=0):
+        if self._device is None or device is not None:
+            self.open_device(device, simulate)
+        report_requested = []
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1,
+                          lambda signum, frame: report_requested.append(True))
+        last_report = time.monotonic()
+        while True:
+            if report_requested or (stats_interval and
+                                    time.monotonic() - last_report >
+                                    stats_interval):
+                del report_requested[:]
+                self.report_stats()
+                last_report = time.monotonic()
+            self.receive_once(KybonetClient.ping_interval * 1000)
+
+    def receive_once(self, timeout=0):
+        # Waits up to `timeout` ms and injects what every source received.
+        # Returns the number of sources that had something.
+        for source in self._sources:
+            source['client'].ping()
+        ready = []
+        for sock, _ in self._poller.poll(timeout):
+            source = self._owners[sock]
+            if source not in ready:
+                ready.append(source)
+        for source in ready:
+            client = source['client']
+            start = time.perf_counter()
+            results = client.receive_all(source['key'])
+            source['receive'].add(time.perf_counter() - start)
+            for events, trace, received, decrypted in results:
+                if not events:
+                    continue
+                client._device.write_events(events)
+                client.tracer.record(events, trace, received, decrypted,
+                                     time.time())
+        return len(ready)
+
+    def report_stats(self):
+        for source in self._sources:
+            client = source['client']
+            logger.info('Source {}: messages={} bytes={} receive+decrypt: '
+                        '{}'.format(source['name'], client.messages_received,
+                                    client.bytes_received,
+                                    source['receive']))
+            for line in client.tracer.report():
+                logger.info('Latency {}: {}'.format(source['name'], line))
+            if client.key_states:
+                logger.info('Key states {}: received={} keys released='
+                            '{}'.format(source['name'], client.key_states,
+                                        client.stuck_keys))
+        if hasattr(self._device, 'stats'):
+            logger.info('Injection: {}'.format(self._device.stats()))
+
+
+def parse_server(address, default_port=5555):
+    # 'ip' or 'ip:port'.
+    ip, _, port = address.rpartition(':')
+    if not ip:
+        return address, default_port
+    return ip, int(port)
 
 
 def main(args=None):
@@ -75,15 +623,77 @@ def main(args=None):
 
     logging.basicConfig(level=log_level, format=log_fmt)
 
-    client = KybonetClient()
-    client.connect(ip=args.ip, port=args.port)
+    if args.ip is not None and args.id_rsa is None:
+        logger.error('A private key (-i) is needed.')
+        sys.exit(1)
+    if args.ip is None and not args.server:
+        logger.error('A server (ip, or --server) is needed.')
+        sys.exit(1)
+    if args.udp_port and args.encryption != 'session':
+        logger.error('--udp-port requires session encryption')
+        sys.exit(1)
+    if args.server:
+        return run_multi(args)
 
     with open(args.id_rsa, 'rb') as f:
         private_key = import_private_key(f.read())
 
+    client = KybonetClient(encryption=args.encryption)
+    if args.encryption == 'rsa':
+        # Legacy servers don't use topics.
+        topic = b''
+    else:
+        topic = fingerprint(private_key.public_key())
+    client.connect(ip=args.ip, port=args.port, topic=topic)
+    if args.udp_port:
+        client.connect_datagram(ip=args.ip, port=args.udp_port)
+
     logger.info('Connected to {}:{}'.format(args.ip, args.port))
+    device = create_device(args)
+    try:
+        if args.pipeline:
+            client.run_pipelined(key=private_key, device=device,
+                                 stats_interval=args.stats_interval,
+                                 queue_size=args.queue_size)
+        else:
+            client.run(key=private_key, device=device,
+                       stats_interval=args.stats_interval)
+    except UnsupportedVersion as e:
+        logger.error(e)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+
+
+def create_device(args):
+    sink = 'null' if args.simulate else args.sink
+    start = time.perf_counter()
+    device = open_sink(sink, capabilities=args.capabilities)
+    logger.debug('Sink "{}" opened in {:.1f}ms'.format(
+                    sink, (time.perf_counter() - start) * 1e3))
+    return device
+
+
+def run_multi(args):
+    servers = [(args.ip, args.id_rsa)] if args.ip is not None else []
+    servers.extend(args.server)
+    client = MultiClient(encryption=args.encryption)
+    for address, key_file in servers:
+        with open(key_file, 'rb') as f:
+            private_key = import_private_key(f.read())
+        ip, port = parse_server(address, default_port=args.port)
+        client.connect(ip=ip, port=port, key=private_key,
+                       udp_port=args.udp_port)
+        logger.info('Connected to {}:{}'.format(ip, port))
+    if args.pipeline:
+        logger.warning('--pipeline is not available with several servers, '
+                       'ignored.')
+    client.open_device(create_device(args))
     try:
-        client.run(key=private_key, simulate=args.simulate)
+        client.run(stats_interval=args.stats_interval)
+    except UnsupportedVersion as e:
+        logger.error(e)
+        sys.exit(1)
     except KeyboardInterrupt:
         pass
 
@@ -4,9 +4,18 @@ from cryptography.hazmat.primitives import serialization
 from collections import namedtuple
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from cryptography.exceptions import InvalidTag
+import os
+import struct
+import time
 
 KeysPair = namedtuple('KeysPair', ['private', 'public'])
 
+# 4 bytes of key id + 8 bytes of counter = 12 bytes ChaCha20-Poly1305 nonce.
+_nonce = struct.Struct('>IQ')
+_session_key = struct.Struct('>I32s')
+
 
 def generate_keys():
     private = rsa.generate_private_key(public_exponent=65537,
@@ -38,6 +47,15 @@ def import_private_key(key):
                                               backend=default_backend())
 
 
+def fingerprint(public_key, size=8):
+    der = public_key.public_bytes(
+                encoding=serialization.Encoding.DER,
+                format=serialization.PublicFormat.SubjectPublicKeyInfo)
+    digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
+    digest.update(der)
+    return digest.finalize()[:size]
+
+
 def encrypt(message, public_key):
     encrypted = public_key.encrypt(
                     message,
@@ -58,8 +76,73 @@ def decrypt(message, private_key):
     return decrypted
 
 
+class SessionKey:
+    # Symmetric key shared with one subscriber. The sender keeps a message
+    # counter that is never reused with the same key; the receiver only
+    # accepts counters greater than the last one it opened (no replays).
+    # Messages arriving through different channels (e.g. a reliable one and
+    # datagrams) share the counter space, but each channel has its own
+    # replay window, as one can overtake the other.
+    max_messages = 2**32
+
+    def __init__(self, key_id, key):
+        self.key_id = key_id
+        self.key = key
+        self.created = time.monotonic()
+        self._aead = ChaCha20Poly1305(key)
+        self._counter = 0
+        self._last_counters = {}
+
+    @classmethod
+    def generate(cls):
+        key_id = int.from_bytes(os.urandom(4), 'big')
+        return cls(key_id, ChaCha20Poly1305.generate_key())
+
+    @classmethod
+    def load(cls, data):
+        try:
+            key_id, key = _session_key.unpack(data)
+        except struct.error:
+            raise ValueError('Invalid session key')
+        return cls(key_id, key)
+
+    def export(self):
+        return _session_key.pack(self.key_id, self.key)
+
+    @property
+    def messages(self):
+        return self._counter
+
+    def age(self):
+        return time.monotonic() - self.created
+
+    def next_counter(self):
+        if self._counter >= self.max_messages:
+            raise ValueError('Session key exhausted')
+        counter = self._counter
+        self._counter += 1
+        return counter
+
+    def seal(self, counter, message, associated_data=None):
+        nonce = _nonce.pack(self.key_id, counter)
+        return self._aead.encrypt(nonce, message, associated_data)
+
+    def last_counter(self, channel=None):
+        return self._last_counters.get(channel, -1)
+
+    def open(self, counter, message, associated_data=None, channel=None):
+        if counter <= self.last_counter(channel):
+            raise ValueError('Replayed message ({})'.format(counter))
+        nonce = _nonce.pack(self.key_id, counter)
+        try:
+            decrypted = self._aead.decrypt(nonce, message, associated_data)
+        except InvalidTag:
+            raise ValueError('Message authentication failed')
+        self._last_counters[channel] = counter
+        return decrypted
+
+
 def main():
-    import os
     import os.path
     default_dir = os.path.expanduser("~")
     default_name = 'id_rsa'
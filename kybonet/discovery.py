@@ -0,0 +1,169 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import evdev
+from evdev import ecodes
+
+logger = logging.getLogger(__name__)
+
+SYSFS_INPUT = '/sys/class/input'
+DEV_INPUT = '/dev/input'
+
+# sysfs capability bitmaps are printed as space separated hex words of
+# `long` size, most significant word first.
+_long_bits = struct.calcsize('l') * 8
+
+# inotify (include/uapi/linux/inotify.h)
+IN_ATTRIB = 0x00000004
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# wd, mask, cookie, len (+ name)
+_inotify_event = struct.Struct('iIII')
+
+
+def parse_bitmap(text):
+    bits = 0
+    for word in text.split():
+        bits = (bits << _long_bits) | int(word, 16)
+    codes = []
+    code = 0
+    while bits:
+        if bits & 1:
+            codes.append(code)
+        bits >>= 1
+        code += 1
+    return codes
+
+
+def _read(path):
+    with open(path, 'r') as f:
+        return f.read().strip()
+
+
+class DeviceInfo:
+    # What kybonet needs to know about an input node, taken from sysfs so
+    # the node doesn't have to be opened.
+    def __init__(self, path, name, capabilities):
+        self.path = path
+        self.name = name
+        self.capabilities = capabilities
+
+    @classmethod
+    def from_sysfs(cls, event_name, sysfs=SYSFS_INPUT, dev=DEV_INPUT):
+        device = os.path.join(sysfs, event_name, 'device')
+        capabilities = {}
+        for etype, filename in ((ecodes.EV_KEY, 'key'),
+                                (ecodes.EV_REL, 'rel')):
+            bitmap = os.path.join(device, 'capabilities', filename)
+            if os.path.exists(bitmap):
+                capabilities[etype] = parse_bitmap(_read(bitmap))
+        return cls(os.path.join(dev, event_name),
+                   _read(os.path.join(device, 'name')), capabilities)
+
+    @classmethod
+    def from_device(cls, device):
+        return cls(device.path, device.name, device.capabilities())
+
+    @property
+    def role(self):
+        keys = self.capabilities.get(ecodes.EV_KEY, ())
+        if ecodes.BTN_MOUSE in keys:
+            return 'mouse'
+        if ecodes.KEY_A in keys:
+            return 'keyboard'
+        return None
+
+    def open(self):
+        return evdev.InputDevice(self.path)
+
+
+def list_devices(sysfs=SYSFS_INPUT, dev=DEV_INPUT):
+    # Mice and keyboards. Without sysfs (e.g. in some containers) every
+    # node has to be opened to read its capabilities.
+    if not os.path.isdir(sysfs):
+        infos = []
+        for path in evdev.list_devices(dev):
+            device = evdev.InputDevice(path)
+            infos.append(DeviceInfo.from_device(device))
+            device.close()
+    else:
+        infos = []
+        for event_name in sorted(os.listdir(sysfs)):
+            if not event_name.startswith('event'):
+                continue
+            try:
+                infos.append(DeviceInfo.from_sysfs(event_name, sysfs, dev))
+            except OSError:
+                # Removed while scanning.
+                continue
+    return [info for info in infos if info.role is not None]
+
+
+def device_info(path, sysfs=SYSFS_INPUT, dev=DEV_INPUT):
+    # None if the node is gone or is not a mouse or a keyboard.
+    try:
+        if os.path.isdir(sysfs):
+            info = DeviceInfo.from_sysfs(os.path.basename(path), sysfs, dev)
+        else:
+            device = evdev.InputDevice(path)
+            info = DeviceInfo.from_device(device)
+            device.close()
+    except OSError:
+        return None
+    return info if info.role is not None else None
+
+
+class HotplugWatcher:
+    # inotify watch on /dev/input. fileno() can be registered in a selector
+    # (or an asyncio loop); read() returns ('add' | 'remove', path) pairs.
+    # udev creates the node before setting its permissions, so a node is
+    # reported as added on creation and again on attribute changes, and
+    # the caller has to ignore the ones it can't open yet or already has.
+    def __init__(self, dev=DEV_INPUT):
+        self.dev = dev
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        wd = libc.inotify_add_watch(self._fd, os.fsencode(dev),
+                                    IN_CREATE | IN_ATTRIB | IN_DELETE)
+        if wd < 0:
+            error = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(error, 'inotify_add_watch failed', dev)
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def read(self):
+        try:
+            data = os.read(self._fd, 4096)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        changes = []
+        offset = 0
+        while offset + _inotify_event.size <= len(data):
+            _, mask, _, length = _inotify_event.unpack_from(data, offset)
+            offset += _inotify_event.size
+            name = data[offset:offset + length].rstrip(b'\0').decode()
+            offset += length
+            if not name.startswith('event'):
+                continue
+            path = os.path.join(self.dev, name)
+            if mask & IN_DELETE:
+                changes.append(('remove', path))
+            elif mask & (IN_CREATE | IN_ATTRIB):
+                changes.append(('add', path))
+        return changes
@@ -0,0 +1,127 @@
+from evdev import ecodes
+from .input_devices import keycode_from_str
+
+_modifiers = {ecodes.KEY_LEFTCTRL: 'ctrl',
+              ecodes.KEY_RIGHTCTRL: 'ctrl',
+              ecodes.KEY_LEFTALT: 'alt',
+              ecodes.KEY_RIGHTALT: 'alt',
+              ecodes.KEY_LEFTSHIFT: 'shift',
+              ecodes.KEY_RIGHTSHIFT: 'shift',
+              ecodes.KEY_LEFTMETA: 'meta',
+              ecodes.KEY_RIGHTMETA: 'meta'}
+
+MODIFIERS = frozenset(_modifiers.values())
+
+
+class UnknownHotkey(Exception):
+    pass
+
+
+class InvalidHotkey(ValueError):
+    pass
+
+
+def parse_chord(key):
+    # 'f7' -> (frozenset(), KEY_F7)
+    # 'ctrl+alt+1' -> (frozenset({'ctrl', 'alt'}), KEY_1)
+    if isinstance(key, int):
+        return frozenset(), key
+    if not isinstance(key, str):
+        raise InvalidHotkey('Invalid key: "{}"'.format(key))
+    parts = [p.strip().lower() for p in key.split('+')]
+    modifiers = frozenset(parts[:-1])
+    unknown = modifiers - MODIFIERS
+    if unknown:
+        raise InvalidHotkey('Invalid modifier(s) in "{}": {}'.format(
+                                            key, ', '.join(sorted(unknown))))
+    keycode = keycode_from_str(parts[-1])
+    if keycode is None:
+        raise InvalidHotkey('Invalid key: "{}"'.format(key))
+    return modifiers, keycode
+
+
+class Hotkey:
+    def __init__(self, name, callback, args=()):
+        self.name = name
+        self.callback = callback
+        self.args = args
+        self.chord = None
+
+    def run(self):
+        self.callback(*self.args)
+
+
+class Hotkeys:
+    # Hotkeys indexed by the keycode that completes the chord, then by the
+    # set of modifiers that must be held, so each key event is checked with
+    # two dict lookups. Modifiers are forwarded as any other key; only the
+    # press and release of the key completing a chord are swallowed.
+    def __init__(self):
+        self._hotkeys = {}
+        self._by_key = {}
+        self._held = {}
+        self._active = {}
+
+    def __contains__(self, name):
+        return name in self._hotkeys
+
+    def add(self, name, callback, args=(), key=None):
+        if name in self._hotkeys:
+            self.assign(name, None)
+        self._hotkeys[name] = Hotkey(name, callback, args)
+        if key:
+            self.assign(name, key)
+
+    def assign(self, name, key):
+        if name not in self._hotkeys:
+            raise UnknownHotkey('Unknown hotkey: "{}"'.format(name))
+        hotkey = self._hotkeys[name]
+        chord = None if key is None else parse_chord(key)
+        if chord is not None:
+            modifiers, keycode = chord
+            other = self._by_key.get(keycode, {}).get(modifiers)
+            if other is not None and other is not hotkey:
+                raise InvalidHotkey('"{}" is already assigned to "{}"'.format(
+                                                            key, other.name))
+        if hotkey.chord is not None:
+            modifiers, keycode = hotkey.chord
+            del self._by_key[keycode][modifiers]
+            if not self._by_key[keycode]:
+                del self._by_key[keycode]
+            hotkey.chord = None
+        if chord is not None:
+            modifiers, keycode = chord
+            self._by_key.setdefault(keycode, {})[modifiers] = hotkey
+            hotkey.chord = chord
+
+    def is_trigger(self, code):
+        # True if the key completes a chord (its events may run a hotkey).
+        return code in self._by_key
+
+    def held_modifiers(self):
+        return frozenset(m for m, count in self._held.items() if count)
+
+    def feed_key(self, code, value):
+        # An EV_KEY event, given by its code and value. Returns the hotkey
+        # when it's the press or the release of a key that completes a chord
+        # (the event must be swallowed), None if it has to be forwarded.
+        modifier = _modifiers.get(code)
+        if modifier is not None:
+            count = self._held.get(modifier, 0)
+            if value == 1:
+                self._held[modifier] = count + 1
+            elif value == 0:
+                self._held[modifier] = max(count - 1, 0)
+            return None
+        if value == 0:
+            return self._active.pop(code, None)
+        chords = self._by_key.get(code)
+        if chords is None:
+            return None
+        if value == 1:
+            hotkey = chords.get(self.held_modifiers())
+            if hotkey is not None:
+                self._active[code] = hotkey
+            return hotkey
+        # autorepeat of an active chord
+        return self._active.get(code)
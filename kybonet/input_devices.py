@@ -1,6 +1,9 @@
-import evdev
+import os
+import struct
 import time
+from array import array
 from evdev import UInput, ecodes
+from .discovery import list_devices
 
 _ev_key_codes = {ecodes.BTN_MOUSE: 'left',
                  ecodes.BTN_RIGHT: 'right',
@@ -15,17 +18,49 @@ _ev_rel_codes = {ecodes.REL_X: 'deltaX',
                  ecodes.REL_Y: 'deltaY',
                  ecodes.REL_WHEEL: 'deltaWheel'}
 
+# type, code, value, sequence number, timestamp
+_event_struct = struct.Struct('<HHiId')
+
+# struct input_event (linux/input.h): struct timeval, type, code, value. The
+# kernel sets the time of the events written to uinput.
+_input_event = struct.Struct('llHHi')
+
+# Capabilities of the virtual device. 'full' is every key evdev knows of;
+# 'basic' is the keys of a regular keyboard and the mouse buttons, a sixth
+# of the codes to register, so the device is created faster.
+_rel_codes = [ecodes.REL_X, ecodes.REL_Y, ecodes.REL_WHEEL]
+DEVICE_CAPABILITIES = {
+    'full': {ecodes.EV_KEY: [*ecodes.keys.keys()],
+             ecodes.EV_REL: _rel_codes},
+    'basic': {ecodes.EV_KEY: [*range(ecodes.KEY_ESC, ecodes.KEY_MICMUTE + 1),
+                              *range(ecodes.BTN_MOUSE, ecodes.BTN_TASK + 1)],
+              ecodes.EV_REL: _rel_codes}}
+
 
 class PseudoEvent:
-    def __init__(self, etype, code, value, time):
+    __slots__ = ('etype', 'code', 'value', 'time', 'seq')
+    packed_size = _event_struct.size
+
+    def __init__(self, etype, code, value, time, seq=0):
         self.etype = etype
         self.code = code
         self.value = value
         self.time = time
+        self.seq = seq
+
+    def pack(self):
+        return _event_struct.pack(self.etype, self.code, self.value,
+                                  self.seq, self.time)
+
+    @classmethod
+    def unpack(cls, data, offset=0):
+        etype, code, value, seq, t = _event_struct.unpack_from(data, offset)
+        return cls(etype, code, value, t, seq)
 
     @classmethod
     def from_event(cls, event):
-        return cls(event.type, event.code, event.value, time.time())
+        # Kernel timestamp of the event (wall clock).
+        return cls(event.type, event.code, event.value, event.timestamp())
 
     @classmethod
     def KeyPress(cls, code):
@@ -39,6 +74,11 @@ class PseudoEvent:
     def type(self):
         return self.etype
 
+    def timestamp(self):
+        # Same as evdev's InputEvent, so recorded events can be read back
+        # as if they came from a device.
+        return self.time
+
     def is_valid_mouse_event(self):
         if self.etype == ecodes.EV_REL:
             if self.code in _ev_rel_codes:
@@ -104,11 +144,14 @@ class RelativeMovement:
         self.wheel = 0
         self.time = time.time()
 
-    def set(self, x, y, wheel):
+    def set(self, x, y, wheel, timestamp=None):
         self.x = x
         self.y = y
         self.wheel = wheel
-        self.time = time.time()
+        self.time = time.time() if timestamp is None else timestamp
+
+    def is_empty(self):
+        return self.x == 0 and self.y == 0 and self.wheel == 0
 
     def is_mergeable(self, x, y, wheel):
         # a new relative movement can be merged if there is no change in any
@@ -119,7 +162,10 @@ class RelativeMovement:
         else:
             return True
 
-    def merge(self, x, y, wheel):
+    def merge(self, x, y, wheel, timestamp=None):
+        # A merged movement keeps the timestamp of its first event.
+        if self.is_empty() and timestamp is not None:
+            self.time = timestamp
         self.x += x
         self.y += y
         self.wheel += wheel
@@ -138,21 +184,439 @@ class RelativeMovement:
                                       time=self.time))
         return events
 
+    def append_to(self, batch):
+        # Same as generate_events(), into an EventBatch.
+        if self.x != 0:
+            batch.append(ecodes.EV_REL, ecodes.REL_X, self.x, self.time)
+        if self.y != 0:
+            batch.append(ecodes.EV_REL, ecodes.REL_Y, self.y, self.time)
+        if self.wheel != 0:
+            batch.append(ecodes.EV_REL, ecodes.REL_WHEEL, self.wheel,
+                         self.time)
 
-class FakeDevice:
-    _cap = {ecodes.EV_KEY: [*ecodes.keys.keys()],
-            ecodes.EV_REL: [ecodes.REL_X, ecodes.REL_Y, ecodes.REL_WHEEL]}
 
-    def __init__(self, name, version=0x1):
-        self.name = name
-        self.ui = UInput(self._cap, name=name, version=version)
+class EventBatch:
+    # The events of a read as columns (type, code, value, time) in typed
+    # arrays, allocated once and reused from one read to the next, so the
+    # hot path doesn't create an object per event. Only the first `length`
+    # entries are valid; the arrays grow (doubling) when a read doesn't fit.
+    __slots__ = ('etypes', 'codes', 'values', 'times', 'length')
+
+    def __init__(self, capacity=64):
+        self.etypes = array('H', bytes(2 * capacity))
+        self.codes = array('H', bytes(2 * capacity))
+        self.values = array('i', bytes(4 * capacity))
+        self.times = array('d', bytes(8 * capacity))
+        self.length = 0
+
+    @classmethod
+    def from_events(cls, events):
+        batch = cls(max(len(events), 1))
+        for e in events:
+            batch.append(e.type, e.code, e.value, e.timestamp())
+        return batch
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def capacity(self):
+        return len(self.etypes)
+
+    def clear(self):
+        self.length = 0
+        return self
+
+    def _grow(self):
+        for column in (self.etypes, self.codes, self.values, self.times):
+            column.extend(column)
+
+    def append(self, etype, code, value, time):
+        n = self.length
+        if n == len(self.etypes):
+            self._grow()
+        self._put(n, etype, code, value, time)
+        self.length = n + 1
+
+    def move(self, src, dst):
+        self._put(dst, self.etypes[src], self.codes[src], self.values[src],
+                  self.times[src])
+
+    def is_motion(self, start=0, end=None):
+        # Only relative motion between start and end.
+        end = self.length if end is None else end
+        ev_rel = ecodes.EV_REL
+        etypes = self.etypes
+        for i in range(start, end):
+            if etypes[i] != ev_rel:
+                return False
+        return True
+
+    def merge_motion(self):
+        # In place, with the same rules as merging RelativeMovements: runs of
+        # relative motion are summed while no axis changes direction, and
+        # written back as one event per axis (x, y, wheel) with the time of
+        # the first event of the run. A run never yields more events than it
+        # had, so the output never overtakes the input.
+        etypes, codes, values, times = (self.etypes, self.codes, self.values,
+                                        self.times)
+        ev_rel = ecodes.EV_REL
+        rel_x, rel_y, rel_wheel = ecodes.REL_X, ecodes.REL_Y, ecodes.REL_WHEEL
+        x = y = wheel = 0
+        t = 0.0
+        j = 0
+        for i in range(self.length):
+            if etypes[i] == ev_rel:
+                code = codes[i]
+                value = values[i]
+                dx = value if code == rel_x else 0
+                dy = value if code == rel_y else 0
+                dw = value if code == rel_wheel else 0
+                if dx * x < 0 or dy * y < 0 or dw * wheel < 0:
+                    j = self._put_motion(j, x, y, wheel, t)
+                    x = y = wheel = 0
+                if x == 0 and y == 0 and wheel == 0:
+                    t = times[i]
+                x += dx
+                y += dy
+                wheel += dw
+            else:
+                j = self._put_motion(j, x, y, wheel, t)
+                x = y = wheel = 0
+                if i != j:
+                    self.move(i, j)
+                j += 1
+        self.length = self._put_motion(j, x, y, wheel, t)
+        return self
+
+    def _put_motion(self, j, x, y, wheel, t):
+        if x:
+            self._put(j, ecodes.EV_REL, ecodes.REL_X, x, t)
+            j += 1
+        if y:
+            self._put(j, ecodes.EV_REL, ecodes.REL_Y, y, t)
+            j += 1
+        if wheel:
+            self._put(j, ecodes.EV_REL, ecodes.REL_WHEEL, wheel, t)
+            j += 1
+        return j
+
+    def _put(self, i, etype, code, value, time):
+        self.etypes[i] = etype
+        self.codes[i] = code
+        self.values[i] = value
+        self.times[i] = time
+
+    def event(self, i):
+        return PseudoEvent(self.etypes[i], self.codes[i], self.values[i],
+                           self.times[i])
+
+    def events(self, start=0, end=None):
+        end = self.length if end is None else end
+        return [self.event(i) for i in range(start, end)]
+
+    def pack_into(self, buffer, offset, start=0, end=None):
+        # Same layout as PseudoEvent.pack(), for each event.
+        end = self.length if end is None else end
+        size = _event_struct.size
+        pack_into = _event_struct.pack_into
+        etypes, codes, values, times = (self.etypes, self.codes, self.values,
+                                        self.times)
+        for i in range(start, end):
+            pack_into(buffer, offset, etypes[i], codes[i], values[i], 0,
+                      times[i])
+            offset += size
+
+
+class MotionCoalescer:
+    # Accumulates relative motion across reads for up to `window` seconds,
+    # so a 1000 Hz mouse doesn't produce a message per report. The same sign
+    # rules as merge_events apply: a change of direction flushes what was
+    # pending. With `adaptive`, the window follows the measured cost of
+    # sending a message (cost_factor times the average cost), bounded by
+    # min_window/max_window. `floor` is the minimum window for the current
+    # subscriber (1 / its max message rate).
+    def __init__(self, window=0.004, min_window=0.002, max_window=0.008,
+                 adaptive=True, cost_factor=4.0):
+        self.window = window
+        self.min_window = min(min_window, window)
+        self.max_window = max(max_window, window)
+        self.adaptive = adaptive
+        self.cost_factor = cost_factor
+        self.floor = 0.0
+        self._cost = None
+        self._movement = RelativeMovement()
+        self._deadline = None
+        # stats
+        self.merged = 0
+        self.flushes = 0
+
+    @property
+    def pending(self):
+        return self._deadline is not None
+
+    def add(self, x, y, wheel, timestamp, now, batch):
+        # What was pending is appended to `batch` (to be sent right away) if
+        # the direction changed.
+        if self._deadline is not None and \
+                not self._movement.is_mergeable(x, y, wheel):
+            self.flush_into(batch)
+        if self._deadline is None:
+            self._movement.set(x, y, wheel, timestamp)
+            self._deadline = now + max(self.window, self.floor)
+        else:
+            self._movement.merge(x, y, wheel, timestamp)
+            self.merged += 1
+
+    def flush(self):
+        if self._deadline is None:
+            return []
+        events = self._movement.generate_events()
+        self._reset()
+        return events
+
+    def flush_into(self, batch):
+        if self._deadline is None:
+            return
+        self._movement.append_to(batch)
+        self._reset()
+
+    def _reset(self):
+        self._movement.set(0, 0, 0, 0)
+        self._deadline = None
+        self.flushes += 1
+
+    def due(self, now):
+        return self._deadline is not None and now >= self._deadline
+
+    def timeout(self, now, default=None):
+        if self._deadline is None:
+            return default
+        timeout = max(self._deadline - now, 0)
+        return timeout if default is None else min(timeout, default)
+
+    def record_cost(self, seconds):
+        if not self.adaptive:
+            return
+        if self._cost is None:
+            self._cost = seconds
+        else:
+            self._cost = 0.9 * self._cost + 0.1 * seconds
+        self.window = min(max(self.cost_factor * self._cost,
+                              self.min_window), self.max_window)
+
+
+def merge_backlog(frames):
+    # Frames that piled up while the previous ones were being injected. The
+    # motion in them is stale, only where the pointer ends up matters, so
+    # runs of motion-only frames are summed into one. Frames with keys or
+    # buttons are kept as they are, in order, with the motion received
+    # before them flushed first.
+    merged = []
+    movement = RelativeMovement()
+    movement.set(0, 0, 0, 0)
+    for events in frames:
+        if all(e.is_rel_movement() for e in events):
+            for event in events:
+                movement.merge(*event.get_rel_movement(), event.time)
+            continue
+        if not movement.is_empty():
+            merged.append(movement.generate_events())
+            movement.set(0, 0, 0, 0)
+        merged.append(events)
+    if not movement.is_empty():
+        merged.append(movement.generate_events())
+    return merged
+
+
+class DeviceProfile:
+    # What a device is and which events are forwarded from it, computed once
+    # from its capabilities instead of on every read.
+    # role: 'mouse', 'keyboard' or 'combo' (e.g. keyboard with a touchpad).
+    # accept: (type, code) pairs forwarded. EV_KEY events are only forwarded
+    # when pressed or released (value 0 or 1, no autorepeat).
+    def __init__(self, role, accept):
+        self.role = role
+        self.accept = frozenset(accept)
+        self.merge_motion = role in ('mouse', 'combo')
+        self.has_keys = role in ('keyboard', 'combo')
+
+    @classmethod
+    def from_capabilities(cls, capabilities):
+        keys = set(capabilities.get(ecodes.EV_KEY, ()))
+        rels = set(capabilities.get(ecodes.EV_REL, ()))
+        mouse = ecodes.BTN_MOUSE in keys
+        keyboard = ecodes.KEY_A in keys
+        accept = set()
+        if mouse:
+            accept.update((ecodes.EV_REL, c) for c in rels
+                          if c in _ev_rel_codes)
+            accept.update((ecodes.EV_KEY, c) for c in keys
+                          if c in _ev_key_codes)
+        if keyboard:
+            accept.update((ecodes.EV_KEY, c) for c in keys
+                          if c not in _ev_key_codes)
+        if mouse and keyboard:
+            role = 'combo'
+        elif mouse:
+            role = 'mouse'
+        else:
+            role = 'keyboard'
+        return cls(role, accept)
+
+    @classmethod
+    def from_device(cls, device):
+        return cls.from_capabilities(device.capabilities())
+
+    def load(self, batch, events):
+        # Raw evdev events in, the ones forwarded in `batch` (cleared first).
+        accept = self.accept
+        ev_key = ecodes.EV_KEY
+        append = batch.append
+        batch.clear()
+        for e in events:
+            etype = e.type
+            code = e.code
+            if (etype, code) in accept:
+                value = e.value
+                if etype != ev_key or value == 0 or value == 1:
+                    append(etype, code, value, e.timestamp())
+        return batch
+
+
+class EventWriter:
+    # Injects frames by writing kernel input_event structs to a file
+    # descriptor: the events of each frame followed by a SYN_REPORT, all the
+    # frames given at once packed in one buffer and written with a single
+    # write() call.
+    def __init__(self, fd):
+        self._fd = fd
+        self._buffer = bytearray(64 * _input_event.size)
+        self._started = time.monotonic()
+        # codes of the keys and buttons held down by what was written
+        self.pressed = set()
+        # stats
+        self.writes = 0
+        self.events_written = 0
+        self.write_time = 0.0
 
     def write(self, etype, code, value):
-        self.ui.write(etype, code, value)
-        self.ui.syn()
+        self.write_events([PseudoEvent(etype, code, value, 0.0)])
 
     def write_event(self, event):
-        self.write(event.etype, event.code, event.value)
+        self.write_events([event])
+
+    def write_events(self, events):
+        # All the events of a frame are reported as a single SYN_REPORT, the
+        # same way the kernel reported them in the server.
+        if events:
+            self.write_frames([events])
+
+    def write_frames(self, frames):
+        start = time.perf_counter()
+        size = _input_event.size
+        needed = sum(len(events) + 1 for events in frames) * size
+        if needed > len(self._buffer):
+            self._buffer = bytearray(2 * needed)
+        buffer = self._buffer
+        pack_into = _input_event.pack_into
+        pressed = self.pressed
+        ev_key, ev_syn, syn_report = ecodes.EV_KEY, ecodes.EV_SYN, \
+            ecodes.SYN_REPORT
+        offset = 0
+        for events in frames:
+            if not events:
+                continue
+            for e in events:
+                if e.etype == ev_key:
+                    if e.value == 1:
+                        pressed.add(e.code)
+                    elif e.value == 0:
+                        pressed.discard(e.code)
+                pack_into(buffer, offset, 0, 0, e.etype, e.code, e.value)
+                offset += size
+            pack_into(buffer, offset, 0, 0, ev_syn, syn_report, 0)
+            offset += size
+        if not offset:
+            return
+        data = memoryview(buffer)[:offset]
+        while data:
+            written = os.write(self._fd, data)
+            self.writes += 1
+            data = data[written:]
+        self.events_written += offset // size
+        self.write_time += time.perf_counter() - start
+
+    def stats(self):
+        elapsed = time.monotonic() - self._started
+        return 'writes={} ({:.0f}/s) events={} time: {:.1f}us/write'.format(
+                    self.writes, self.writes / elapsed if elapsed else 0,
+                    self.events_written,
+                    self.write_time / self.writes * 1e6 if self.writes else 0)
+
+
+class FakeDevice(EventWriter):
+    # The uinput virtual device the events are injected into. capabilities:
+    # a DEVICE_CAPABILITIES name or a capabilities dict.
+    def __init__(self, name, version=0x1, capabilities='full'):
+        if isinstance(capabilities, str):
+            capabilities = DEVICE_CAPABILITIES[capabilities]
+        self.name = name
+        self.ui = UInput(capabilities, name=name, version=version)
+        super().__init__(self.ui.fd)
+
+    def close(self):
+        self.ui.close()
+
+
+class NullDevice(EventWriter):
+    # Same packing and write() calls as FakeDevice, to /dev/null: nothing is
+    # injected, but the injection cost can be measured (--simulate).
+    def __init__(self, name='null'):
+        self.name = name
+        super().__init__(os.open(os.devnull, os.O_WRONLY | os.O_CLOEXEC))
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class SourceDevice:
+    # What one source (server) sees of a virtual device shared by several
+    # (see client.MultiClient). The keys pressed through each source are
+    # tracked apart, and a release is only written when no other source
+    # holds the key: a source switching away releases its own keys only.
+    def __init__(self, device, sources):
+        # sources: the SourceDevices of the device, this one included.
+        self.device = device
+        self._sources = sources
+        self.pressed = set()
+
+    def write_events(self, events):
+        if events:
+            self.write_frames([events])
+
+    def write_frames(self, frames):
+        ev_key = ecodes.EV_KEY
+        pressed = self.pressed
+        others = [s.pressed for s in self._sources if s is not self]
+        kept = []
+        for events in frames:
+            frame = []
+            for e in events:
+                if e.etype == ev_key:
+                    if e.value == 1:
+                        pressed.add(e.code)
+                    elif e.value == 0:
+                        pressed.discard(e.code)
+                        if any(e.code in held for held in others):
+                            continue
+                frame.append(e)
+            if frame:
+                kept.append(frame)
+        if kept:
+            self.device.write_frames(kept)
 
 
 def is_mouse(device):
@@ -172,9 +636,8 @@ def is_keyboard(device):
 
 
 def find_devices():
-    devices = [evdev.InputDevice(fn) for fn in evdev.list_devices()]
-    devices = [d for d in devices if is_mouse(d) or is_keyboard(d)]
-    return devices
+    # Only mice and keyboards are opened (see discovery.list_devices).
+    return [info.open() for info in list_devices()]
 
 
 def keycode_from_str(key_str):
@@ -186,10 +649,10 @@ def keycode_from_str(key_str):
 
 
 def main():
-    devices = find_devices()
+    devices = list_devices()
     print('Found {} devices.'.format(len(devices)))
     for d in devices:
-        print('Device: "{}"'.format(d.name))
+        print('Device: "{}" ({}, {})'.format(d.name, d.role, d.path))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,293 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import resource
+import sys
+import tempfile
+import threading
+import time
+import zmq
+from .backends import FakeInputDevice, MOUSE_CAPABILITIES, mouse_trace
+from .bench import percentile
+from .client import KybonetClient
+from .crypto import generate_keys, serialize_public_key, \
+                    serialize_private_key, import_private_key, fingerprint
+from .protocol import ENCRYPTION_MODES
+from .server import KybonetServer
+
+logger = logging.getLogger(__name__)
+
+
+def _thread_cpu():
+    # CPU seconds of the calling thread (time.thread_time() needs 3.7).
+    usage = resource.getrusage(resource.RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description='Fan-out load test: one server with synthetic devices '
+        'and N simulated subscribers, switching between them.')
+    parser.add_argument('-n', '--subscribers', type=int, nargs='+',
+                        default=[10, 50, 100, 200],
+                        help='Numbers of subscribers to test (default: 10 '
+                        '50 100 200).')
+    parser.add_argument('-d', '--duration', type=float, default=5.0,
+                        help='Seconds per test.')
+    parser.add_argument('-s', '--switch-rate', type=float, default=2.0,
+                        help='Target switches per second.')
+    parser.add_argument('-r', '--rate', type=int, default=1000,
+                        help='Mouse reports per second.')
+    parser.add_argument('--reports-per-read', type=int, default=4,
+                        help='Mouse reports returned by each device read.')
+    parser.add_argument('-P', '--processes', type=int, default=0,
+                        help='Client processes (default: 0, all the clients '
+                        'in a thread of the server process).')
+    parser.add_argument('-e', '--encryption', type=str, default='session',
+                        choices=ENCRYPTION_MODES, help='Encryption mode.')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='Save the results as JSON.')
+    return parser.parse_args(args)
+
+
+def run_clients(first, keys, endpoint, encryption, duration, ready,
+                results):
+    # Subscribers first..first+len(keys)-1 (keys as PEM), all polled from
+    # this thread. Puts in `results` what each one received and the cost of
+    # receiving and decrypting every message.
+    context = zmq.Context()
+    poller = zmq.Poller()
+    clients = {}
+    for idx, pem in enumerate(keys, first):
+        key = import_private_key(pem)
+        client = KybonetClient(encryption=encryption)
+        topic = b'' if encryption == 'rsa' else fingerprint(key.public_key())
+        client.connect_endpoint(endpoint, topic=topic, context=context)
+        poller.register(client.socket, zmq.POLLIN)
+        clients[client.socket] = (idx, client, key)
+    arrivals = {idx: [] for idx, _, _ in clients.values()}
+    costs = []
+    ready.put(len(clients))
+    stop = time.monotonic() + duration
+    while time.monotonic() < stop:
+        for socket, _ in poller.poll(100):
+            idx, client, key = clients[socket]
+            start = time.perf_counter()
+            received = client.receive_all(key)
+            costs.append(time.perf_counter() - start)
+            if any(events for events, _, _, _ in received):
+                arrivals[idx].append(time.time())
+    results.put({'arrivals': arrivals,
+                 'costs': costs,
+                 'messages': sum(c.messages_received
+                                 for _, c, _ in clients.values()),
+                 'bytes': sum(c.bytes_received
+                              for _, c, _ in clients.values())})
+    context.destroy(linger=0)
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self._tmp = tempfile.TemporaryDirectory()
+        n = max(args.subscribers)
+        logger.info('Generating {} key pairs...'.format(n))
+        self.public_key_files = []
+        self.private_keys = []
+        for idx in range(n):
+            keys = generate_keys()
+            path = os.path.join(self._tmp.name, 'sub{}.pub'.format(idx))
+            with open(path, 'wb') as f:
+                f.write(serialize_public_key(keys.public))
+            self.public_key_files.append(path)
+            self.private_keys.append(serialize_private_key(keys.private))
+        self.mouse = FakeInputDevice('loadtest mouse', MOUSE_CAPABILITIES)
+        self.reads = mouse_trace(args.rate, rate=args.rate,
+                                 reports_per_read=args.reports_per_read)
+
+    def close(self):
+        self._tmp.cleanup()
+
+    def run(self, n):
+        args = self.args
+        context = zmq.Context()
+        server = KybonetServer(encryption=args.encryption)
+        server.bind('tcp://127.0.0.1:*', context=context)
+        endpoint = server._socket.getsockopt_string(zmq.LAST_ENDPOINT)
+        start = time.perf_counter()
+        for idx in range(n):
+            server.add_subscriber('sub{}'.format(idx),
+                                  id_file=self.public_key_files[idx])
+        setup = time.perf_counter() - start
+
+        workers, ready, results = self._start_clients(n, endpoint)
+        for _ in workers:
+            ready.get(timeout=60)
+        # Let the subscriptions reach the server.
+        deadline = time.monotonic() + 0.5
+        while time.monotonic() < deadline:
+            server.process_requests()
+            time.sleep(0.01)
+
+        switches, events, wall, cpu = self._serve(server, n)
+        collected = [results.get(timeout=args.duration + 60)
+                     for _ in workers]
+        for worker in workers:
+            worker.join()
+        context.destroy(linger=0)
+        return self._summarize(n, setup, switches, events, wall, cpu,
+                               server, collected)
+
+    def _start_clients(self, n, endpoint):
+        args = self.args
+        # The clients outlive the server loop, to receive what's in flight.
+        duration = args.duration + 1.0
+        if args.processes:
+            mp = multiprocessing.get_context('spawn')
+            ready, results = mp.Queue(), mp.Queue()
+            chunks = args.processes
+            start_worker = mp.Process
+        else:
+            ready, results = queue.Queue(), queue.Queue()
+            chunks = 1
+            start_worker = threading.Thread
+        size = -(-n // chunks)
+        workers = []
+        for first in range(0, n, size):
+            keys = self.private_keys[first:min(first + size, n)]
+            worker = start_worker(target=run_clients, daemon=True,
+                                  args=(first, keys, endpoint,
+                                        args.encryption, duration, ready,
+                                        results))
+            worker.start()
+            workers.append(worker)
+        return workers, ready, results
+
+    def _serve(self, server, n):
+        # Feeds the mouse trace at its rate and switches to the next
+        # subscriber every 1 / switch_rate seconds. Only the CPU used by
+        # this thread is measured.
+        args = self.args
+        read_interval = args.reports_per_read / args.rate
+        switch_interval = 1.0 / args.switch_rate
+        switches = []
+        events = 0
+        server.switch(0)
+        cpu0 = _thread_cpu()
+        t0 = time.monotonic()
+        next_read = t0
+        next_switch = t0 + switch_interval
+        i = 0
+        while True:
+            now = time.monotonic()
+            if now - t0 >= args.duration:
+                break
+            if now >= next_switch:
+                idx = (len(switches) + 1) % n
+                switches.append((time.time(), idx))
+                server.switch(idx)
+                next_switch += switch_interval
+            if now >= next_read:
+                read = self.reads[i % len(self.reads)]
+                server.feed(self.mouse, read, (time.time(), now))
+                events += len(read)
+                next_read += read_interval
+                i += 1
+            server.process_requests()
+            server.maintenance()
+            wait = min(next_read, next_switch) - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        wall = time.monotonic() - t0
+        cpu = _thread_cpu() - cpu0
+        return switches, events, wall, cpu
+
+    def _summarize(self, n, setup, switches, events, wall, cpu, server,
+                   collected):
+        arrivals = {}
+        costs = []
+        for result in collected:
+            arrivals.update(result['arrivals'])
+            costs.extend(result['costs'])
+        costs.sort()
+        # Switch latency: from the switch until the new target received its
+        # first event (includes waiting for the next device read and the
+        # session key handover).
+        latencies = []
+        missed = 0
+        for switched, idx in switches:
+            after = [t for t in arrivals[idx] if t >= switched]
+            if after:
+                latencies.append(min(after) - switched)
+            else:
+                missed += 1
+        latencies.sort()
+        received_bytes = sum(r['bytes'] for r in collected)
+        return {'subscribers': n,
+                'setup_ms': setup * 1e3,
+                'events': events,
+                'server_cpu_percent': cpu / wall * 100,
+                'server_cpu_us_per_event': cpu / events * 1e6
+                if events else 0.0,
+                'messages_sent': server.messages_sent,
+                'bytes_sent': server.bytes_sent,
+                'messages_received': sum(r['messages'] for r in collected),
+                'received_kbytes_per_sec': received_bytes / wall / 1e3,
+                'client_us_per_message': sum(costs) / len(costs) * 1e6
+                if costs else 0.0,
+                'client_p99_us': percentile(costs, 99) * 1e6,
+                'clients_cpu_percent': sum(costs) / wall * 100,
+                'switches': len(switches),
+                'switches_missed': missed,
+                'switch_p50_ms': percentile(latencies, 50) * 1e3,
+                'switch_p99_ms': percentile(latencies, 99) * 1e3,
+                'switch_max_ms': latencies[-1] * 1e3 if latencies else 0.0}
+
+
+def report(results):
+    lines = []
+    fmt = '{:>5} {:>9} {:>10} {:>10} {:>10} {:>10} {:>10} {:>9} {:>9}'
+    lines.append(fmt.format('subs', 'setup ms', 'server %', 'us/event',
+                            'recv KB/s', 'client us', 'clients %',
+                            'sw p50', 'sw p99'))
+    for r in results:
+        lines.append(fmt.format(r['subscribers'],
+                                '{:.0f}'.format(r['setup_ms']),
+                                '{:.1f}'.format(r['server_cpu_percent']),
+                                '{:.1f}'.format(r['server_cpu_us_per_event']),
+                                '{:.1f}'.format(r['received_kbytes_per_sec']),
+                                '{:.1f}'.format(r['client_us_per_message']),
+                                '{:.1f}'.format(r['clients_cpu_percent']),
+                                '{:.1f}'.format(r['switch_p50_ms']),
+                                '{:.1f}'.format(r['switch_p99_ms'])))
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    args = parse_args(args=args)
+    logging.basicConfig(level=logging.INFO,
+                        format='%(levelname)s - %(message)s')
+    logging.getLogger('kybonet.server').setLevel(logging.WARNING)
+
+    test = LoadTest(args)
+    results = []
+    try:
+        for n in args.subscribers:
+            logger.info('Testing {} subscribers...'.format(n))
+            results.append(test.run(n))
+    finally:
+        test.close()
+
+    print(report(results))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+        print('Results saved in "{}".'.format(args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
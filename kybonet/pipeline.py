@@ -0,0 +1,159 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from .stats import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+_stop = object()
+
+# Lanes of the prioritized queues: keys and buttons go ahead of motion.
+LANE_KEYS = 0
+LANE_MOTION = 1
+
+
+class Lanes:
+    # Storage of a prioritized queue: FIFO lanes, drained lane 0 first.
+    # Entries are put as (lane, barrier, item) and got as item. An entry with
+    # `barrier` is queued behind everything pending in the lanes after its
+    # own (they are moved to its lane), so it doesn't overtake what was
+    # queued before it, e.g. a click and the motion before it.
+    def __init__(self, count=2):
+        self._lanes = [deque() for _ in range(count)]
+
+    def __len__(self):
+        return sum(len(lane) for lane in self._lanes)
+
+    def append(self, entry):
+        lane, barrier, item = entry
+        target = self._lanes[lane]
+        if barrier:
+            for later in self._lanes[lane + 1:]:
+                target.extend(later)
+                later.clear()
+        target.append(item)
+
+    def popleft(self):
+        for lane in self._lanes:
+            if lane:
+                return lane.popleft()
+        raise IndexError('pop from empty lanes')
+
+    def depths(self):
+        return [len(lane) for lane in self._lanes]
+
+
+class LaneQueue(queue.Queue):
+    # queue.Queue with its items in Lanes: put((lane, barrier, item)).
+    def _init(self, maxsize):
+        self.queue = Lanes()
+
+
+class Stage:
+    # A worker thread fed by a bounded FIFO queue. Items are handled one at
+    # a time, in order. `idle` is called whenever the queue runs empty, and
+    # at least every `idle_interval` seconds (a number, or a callable
+    # returning it, evaluated before waiting for each item). With `lanes`,
+    # items are handled by priority (see Lanes) instead of in order.
+    def __init__(self, name, handler, maxsize=256, idle=None,
+                 idle_interval=0.5, lanes=False):
+        self.name = name
+        self._handler = handler
+        self._idle = idle
+        self._idle_interval = idle_interval
+        self._lanes = lanes
+        if lanes:
+            self._queue = LaneQueue(maxsize=maxsize)
+        else:
+            self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = None
+        # stats
+        self.items = 0
+        self.blocked = 0
+        self.max_depth = 0
+        self.times = LatencyHistogram()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=self.name,
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=2.0):
+        if self._thread is None:
+            return
+        if self.is_current():
+            # Called from the stage itself: handle what's left inline.
+            self.drain()
+            return
+        self._queue.put(self._entry(_stop, LANE_MOTION, False))
+        self._thread.join(timeout)
+        self._thread = None
+
+    def is_current(self):
+        # True when called from the stage's own thread.
+        return self._thread is threading.current_thread()
+
+    def drain(self):
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not _stop:
+                self._handle(item)
+
+    def put(self, item, lane=LANE_KEYS, barrier=False):
+        if self._queue.full():
+            self.blocked += 1
+        self._queue.put(self._entry(item, lane, barrier))
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+
+    def _entry(self, item, lane, barrier):
+        return (lane, barrier, item) if self._lanes else item
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def _handle(self, item):
+        start = time.perf_counter()
+        try:
+            self._handler(*item)
+        except Exception:
+            logger.exception('Error in stage "{}"'.format(self.name))
+        self.times.add(time.perf_counter() - start)
+        self.items += 1
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self._wait_timeout())
+            except queue.Empty:
+                item = None
+            if item is _stop:
+                self.drain()
+                return
+            if item is not None:
+                self._handle(item)
+            if self._idle is not None and (item is None or
+                                           self._queue.empty()):
+                try:
+                    self._idle()
+                except Exception:
+                    logger.exception('Error in stage "{}"'.format(self.name))
+
+    def _wait_timeout(self):
+        if callable(self._idle_interval):
+            return self._idle_interval()
+        return self._idle_interval
+
+    def stats(self):
+        depth = self.depth
+        if self._lanes:
+            with self._queue.mutex:
+                depth = '/'.join(map(str, self._queue.queue.depths()))
+        return '{}: depth={} max_depth={} items={} blocked={} time: {}'.format(
+                    self.name, depth, self.max_depth, self.items,
+                    self.blocked, self.times)
@@ -0,0 +1,239 @@
+import json
+import struct
+import time
+from .crypto import SessionKey, encrypt, decrypt
+from .input_devices import PseudoEvent
+
+ENCRYPTION_MODES = ('session', 'rsa')
+
+# Version 1 is the JSON encoding (still used in rsa mode, so old clients keep
+# working). Version 2 was one binary event per message. Version 3 is a frame:
+# a header (version, number of events) followed by the packed PseudoEvents of
+# one device read.
+PROTOCOL_VERSION = 3
+_frame_header = struct.Struct('<BH')
+MAX_FRAME_EVENTS = 2**16 - 1
+_json_fields = ['etype', 'code', 'value', 'time']
+
+# Message kinds (first byte of every message in session mode).
+MSG_SESSION_KEY = b'K'
+MSG_EVENT = b'E'
+MSG_PING = b'P'
+MSG_PONG = b'Q'
+# Datagram transport: events sent as datagrams (relative motion only) and the
+# datagram a client sends to register its address.
+MSG_DATAGRAM = b'D'
+MSG_HELLO = b'H'
+# Snapshot of the keys and buttons held in the server: the client releases
+# whatever it holds that isn't in it (missed releases, switches).
+MSG_KEY_STATE = b'S'
+
+# kind, session key id, message counter
+_event_header = struct.Struct('>cIQ')
+# Stage stamps sent along with each event message (not encrypted): wall
+# clock time of the device read, and seconds from the read until the message
+# was encrypted (monotonic clock).
+_trace = struct.Struct('<dd')
+# kind, client time (+ client topic)
+_ping = struct.Struct('<cd')
+# kind, client time, server time
+_pong = struct.Struct('<cdd')
+# kind, topic, session key id, message counter
+_hello = struct.Struct('>c8sIQ')
+# Hello counters have the top bit set, so they never share a nonce with the
+# server messages (< SessionKey.max_messages). They are the client wall clock
+# in microseconds, to keep growing when the client restarts.
+_hello_counter_bit = 1 << 63
+# Motion frames bigger than this are not sent as datagrams (MTU).
+MAX_DATAGRAM_EVENTS = 64
+# Key state payload: version, bitmap length, then the bitmap of pressed keys
+# (bit n of the bitmap is key code n; trailing zero bytes are left out).
+_key_state = struct.Struct('<BH')
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class UnknownSession(ValueError):
+    pass
+
+
+class UnsupportedVersion(ProtocolError):
+    pass
+
+
+class LateMessage(ValueError):
+    pass
+
+
+def check_version(version):
+    if version != PROTOCOL_VERSION:
+        raise UnsupportedVersion(
+            'Unsupported protocol version {} (this client speaks version {}). '
+            'Make sure server and client run the same kybonet '
+            'version.'.format(version, PROTOCOL_VERSION))
+
+
+def pack_payload(events):
+    assert len(events) <= MAX_FRAME_EVENTS, 'Frame too big'
+    header = _frame_header.pack(PROTOCOL_VERSION, len(events))
+    return header + b''.join(e.pack() for e in events)
+
+
+def pack_batch(batch, start=0, end=None):
+    # Same as pack_payload(), from the columns of an EventBatch.
+    end = len(batch) if end is None else end
+    assert end - start <= MAX_FRAME_EVENTS, 'Frame too big'
+    data = bytearray(_frame_header.size +
+                     (end - start) * PseudoEvent.packed_size)
+    _frame_header.pack_into(data, 0, PROTOCOL_VERSION, end - start)
+    batch.pack_into(data, _frame_header.size, start, end)
+    return bytes(data)
+
+
+def pack_json_payload(event):
+    event_dict = {k: getattr(event, k) for k in _json_fields}
+    return json.dumps(event_dict).encode('utf-8')
+
+
+def unpack_payload(data):
+    if data[:1] == b'{':
+        return [PseudoEvent(**json.loads(bytes(data).decode('utf-8')))]
+    if len(data) == 0:
+        raise ProtocolError('Empty payload')
+    check_version(data[0])
+    if len(data) < _frame_header.size:
+        raise ProtocolError('Truncated frame')
+    _, count = _frame_header.unpack_from(data)
+    size = PseudoEvent.packed_size
+    if len(data) != _frame_header.size + count * size:
+        raise ProtocolError('Invalid frame size ({})'.format(len(data)))
+    return [PseudoEvent.unpack(data, _frame_header.size + i * size)
+            for i in range(count)]
+
+
+def pack_key_state(codes):
+    codes = list(codes)
+    bitmap = bytearray((max(codes) >> 3) + 1 if codes else 0)
+    for code in codes:
+        bitmap[code >> 3] |= 1 << (code & 7)
+    return _key_state.pack(PROTOCOL_VERSION, len(bitmap)) + bytes(bitmap)
+
+
+def unpack_key_state(data):
+    # The codes of the pressed keys.
+    if len(data) < _key_state.size:
+        raise ProtocolError('Truncated key state')
+    version, length = _key_state.unpack_from(data)
+    check_version(version)
+    if len(data) != _key_state.size + length:
+        raise ProtocolError('Invalid key state size ({})'.format(len(data)))
+    bitmap = bytes(data[_key_state.size:])
+    return frozenset(i * 8 + bit for i, byte in enumerate(bitmap) if byte
+                     for bit in range(8) if byte >> bit & 1)
+
+
+def message_kind(message):
+    return bytes(message[:1])
+
+
+def pack_trace(read, encrypted):
+    return _trace.pack(read, encrypted)
+
+
+def unpack_trace(data):
+    if data is None or len(data) != _trace.size:
+        return None
+    return _trace.unpack(data)
+
+
+def pack_ping(topic, client_time):
+    return _ping.pack(MSG_PING, client_time) + topic
+
+
+def unpack_ping(message):
+    if len(message) < _ping.size:
+        raise ProtocolError('Truncated ping')
+    _, client_time = _ping.unpack_from(message)
+    return bytes(message[_ping.size:]), client_time
+
+
+def pack_pong(client_time, server_time):
+    return _pong.pack(MSG_PONG, client_time, server_time)
+
+
+def unpack_pong(message):
+    if len(message) != _pong.size:
+        raise ProtocolError('Invalid pong')
+    _, client_time, server_time = _pong.unpack(message)
+    return client_time, server_time
+
+
+def pack_session_key(session, public_key):
+    # The protocol version travels with the key, so a client can tell that it
+    # doesn't understand the server before receiving any event.
+    data = bytes((PROTOCOL_VERSION,)) + session.export()
+    encrypted = encrypt(message=data, public_key=public_key)
+    return MSG_SESSION_KEY + encrypted
+
+
+def unpack_session_key(message, private_key):
+    decrypted = decrypt(message=bytes(message[1:]), private_key=private_key)
+    check_version(decrypted[0])
+    return SessionKey.load(decrypted[1:])
+
+
+def pack_event(session, payload, kind=MSG_EVENT):
+    # kind: MSG_EVENT, MSG_DATAGRAM or MSG_KEY_STATE. It's part of the
+    # authenticated header, so a message can't be replayed through another
+    # channel.
+    counter = session.next_counter()
+    header = _event_header.pack(kind, session.key_id, counter)
+    return header + session.seal(counter, payload, header)
+
+
+def unpack_event(message, sessions):
+    if len(message) < _event_header.size:
+        raise ProtocolError('Truncated message')
+    header = bytes(message[:_event_header.size])
+    kind, key_id, counter = _event_header.unpack(header)
+    session = sessions.get(key_id)
+    if session is None:
+        raise UnknownSession('Unknown session key {:08x}'.format(key_id))
+    if kind == MSG_DATAGRAM and \
+            counter < max(session.last_counter(MSG_EVENT),
+                          session.last_counter(MSG_DATAGRAM)):
+        # Sent before a message already received: injecting it now would
+        # reorder the motion (and the clicks sent after it).
+        raise LateMessage('Late datagram ({})'.format(counter))
+    return session.open(counter, bytes(message[_event_header.size:]), header,
+                        channel=kind)
+
+
+def split_datagram(data):
+    # Datagrams are the event message followed by its trace: (message, trace)
+    if len(data) < _event_header.size + _trace.size:
+        raise ProtocolError('Truncated datagram')
+    return data[:-_trace.size], data[-_trace.size:]
+
+
+def pack_hello(topic, session):
+    counter = _hello_counter_bit | int(time.time() * 1e6)
+    header = _hello.pack(MSG_HELLO, topic, session.key_id, counter)
+    return header + session.seal(counter, b'', header)
+
+
+def unpack_hello(message):
+    # (topic, session key id), to find the session to verify it with.
+    if len(message) < _hello.size:
+        raise ProtocolError('Truncated hello')
+    _, topic, key_id, _ = _hello.unpack_from(message)
+    return topic, key_id
+
+
+def verify_hello(message, session):
+    header = bytes(message[:_hello.size])
+    _, _, _, counter = _hello.unpack(header)
+    session.open(counter, bytes(message[_hello.size:]), header,
+                 channel=MSG_HELLO)
@@ -0,0 +1,176 @@
+import json
+import mmap
+import os
+import struct
+from evdev import ecodes
+from .input_devices import PseudoEvent
+
+# File layout: a header (magic, version) followed by records, appended as
+# the devices are read. A device record (index, JSON with its name and
+# capabilities) is written before the first read of that device. A read
+# record holds the time of the read (wall clock) and the raw events
+# returned by it, packed as PseudoEvents with their kernel timestamps.
+MAGIC = b'KYBR'
+FORMAT_VERSION = 1
+_file_header = struct.Struct('<4sB')
+RECORD_DEVICE = 1
+RECORD_READ = 2
+# record type, device index, length of the JSON
+_device_header = struct.Struct('<BHH')
+# record type, device index, number of events, read time
+_read_header = struct.Struct('<BHHd')
+MAX_READ_EVENTS = 2**16 - 1
+# Only what's needed to rebuild the DeviceProfile.
+_recorded_types = (ecodes.EV_KEY, ecodes.EV_REL)
+
+
+class RecordingError(ValueError):
+    pass
+
+
+class Recorder:
+    # Appends the reads of the devices to a recording. Writes are buffered,
+    # so the file is only complete after close(); a record cut short by a
+    # crash is ignored when reading.
+    def __init__(self, path):
+        self.path = path
+        self._indexes = {}
+        self._next_index = 0
+        exists = os.path.isfile(path) and os.path.getsize(path) > 0
+        if exists:
+            # Appending: device indexes continue after the existing ones, and
+            # a record cut short is dropped.
+            recording = Recording(path)
+            self._next_index = max(recording.devices, default=-1) + 1
+            recording.close()
+            os.truncate(path, recording.size)
+        self._file = open(path, 'ab')
+        if not exists:
+            self._file.write(_file_header.pack(MAGIC, FORMAT_VERSION))
+        self.reads = 0
+        self.events = 0
+
+    def record(self, device, events, read_time):
+        index = self._indexes.get(id(device))
+        if index is None:
+            index = self._add_device(device)
+        for i in range(0, len(events), MAX_READ_EVENTS):
+            chunk = events[i:i + MAX_READ_EVENTS]
+            self._file.write(_read_header.pack(RECORD_READ, index, len(chunk),
+                                               read_time))
+            self._file.write(b''.join(
+                PseudoEvent(e.type, e.code, e.value, e.timestamp()).pack()
+                for e in chunk))
+        self.reads += 1
+        self.events += len(events)
+
+    def _add_device(self, device):
+        index = self._next_index
+        self._next_index += 1
+        self._indexes[id(device)] = index
+        capabilities = device.capabilities()
+        info = {'name': device.name,
+                'capabilities': {str(t): list(capabilities.get(t, ()))
+                                 for t in _recorded_types}}
+        data = json.dumps(info).encode('utf-8')
+        self._file.write(_device_header.pack(RECORD_DEVICE, index, len(data)))
+        self._file.write(data)
+        return index
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+class RecordedDevice:
+    # Stands for the recorded device: what the server needs from an input
+    # device, without the device.
+    def __init__(self, index, name, capabilities):
+        self.index = index
+        self.name = name
+        self.path = None
+        self._capabilities = capabilities
+
+    def capabilities(self):
+        return self._capabilities
+
+    def grab(self):
+        pass
+
+    def ungrab(self):
+        pass
+
+
+class Recording:
+    # Memory-mapped recording. Events are unpacked from the map as the reads
+    # are iterated, the file is never loaded as a whole.
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < _file_header.size:
+                raise RecordingError('Not a kybonet recording: {}'.format(
+                                        path))
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = _file_header.unpack_from(self._map)
+        if magic != MAGIC:
+            self.close()
+            raise RecordingError('Not a kybonet recording: {}'.format(path))
+        if version != FORMAT_VERSION:
+            self.close()
+            raise RecordingError('Unsupported recording version {}'.format(
+                                    version))
+        self.devices = {}
+        # Bytes up to the end of the last complete record.
+        self.size = _file_header.size
+        for _ in self._records(devices_only=True):
+            pass
+
+    def close(self):
+        self._map.close()
+
+    def reads(self):
+        # (device, read time, events), in the order they were recorded.
+        return self._records()
+
+    def _records(self, devices_only=False):
+        data = self._map
+        size = PseudoEvent.packed_size
+        offset = _file_header.size
+        while offset < len(data):
+            kind = data[offset]
+            if kind == RECORD_DEVICE:
+                if offset + _device_header.size > len(data):
+                    return
+                _, index, length = _device_header.unpack_from(data, offset)
+                offset += _device_header.size
+                if offset + length > len(data):
+                    return
+                info = json.loads(bytes(data[offset:offset + length]))
+                offset += length
+                self.size = offset
+                if index not in self.devices:
+                    capabilities = {int(t): codes for t, codes in
+                                    info['capabilities'].items()}
+                    self.devices[index] = RecordedDevice(
+                                            index, info['name'], capabilities)
+            elif kind == RECORD_READ:
+                if offset + _read_header.size > len(data):
+                    return
+                _, index, count, read_time = _read_header.unpack_from(
+                                                                data, offset)
+                offset += _read_header.size
+                end = offset + count * size
+                if end > len(data):
+                    return
+                self.size = end
+                if not devices_only:
+                    events = [PseudoEvent.unpack(data, o)
+                              for o in range(offset, end, size)]
+                    yield self.devices[index], read_time, events
+                offset = end
+            else:
+                raise RecordingError('Invalid record at offset {}'.format(
+                                        offset))
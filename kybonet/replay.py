@@ -0,0 +1,183 @@
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+import zmq
+from .client import KybonetClient
+from .crypto import generate_keys, serialize_public_key, fingerprint
+from .recording import Recording, RecordingError
+from .server import KybonetServer
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description='Replay a recording (kybonet-server --record) through '
+        'the server, to clients or to a client in this same process.')
+    parser.add_argument('recording', type=str, help='Recording file.')
+    parser.add_argument('-p', '--port', type=int, default=5555, help='Port.')
+    parser.add_argument('-i', '--public-key', type=str, default=None,
+                        help='Public key of the client the events are sent '
+                        'to.')
+    parser.add_argument('-l', '--loopback', action='store_true',
+                        help='Send the events to a client in this process '
+                        '(nothing is injected) and report its latency.')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Replay speed: 1 is real time, 2 twice as fast, '
+                        '0 as fast as possible (default: 1).')
+    parser.add_argument('-n', '--repeat', type=int, default=1,
+                        help='Times the recording is replayed.')
+    parser.add_argument('--delay', type=float, default=1.0,
+                        help='Seconds given to the clients to connect before '
+                        'replaying.')
+    verbosity = parser.add_mutually_exclusive_group(required=False)
+    verbosity.add_argument('-q', '--quiet', action='store_true',
+                           help='Reduce output messages.')
+    verbosity.add_argument('-v', '--verbose', action='store_true',
+                           help='Increment output messages.')
+    return parser.parse_args(args)
+
+
+def replay(server, recording, speed=1.0, idle=None):
+    # Feeds the recorded reads to the server, spaced as they were read
+    # divided by `speed` (0: as fast as possible). `idle` is called between
+    # reads. Event times are moved to the time of the replay, so latencies
+    # are measured from it. Returns the number of reads and events.
+    reads = events_count = 0
+    first = None
+    start = time.monotonic()
+    for device, read_time, events in recording.reads():
+        if first is None:
+            first = read_time
+        while speed:
+            wait = start + (read_time - first) / speed - time.monotonic()
+            if wait <= 0:
+                break
+            if idle is not None:
+                idle()
+            time.sleep(min(wait, 0.05))
+        now = time.time()
+        shift = now - read_time
+        for event in events:
+            event.time += shift
+        server.feed(device, events, (now, time.monotonic()))
+        if idle is not None:
+            idle()
+        reads += 1
+        events_count += len(events)
+    return reads, events_count
+
+
+class Loopback:
+    # A client in this process, connected through inproc, that decrypts
+    # everything but injects nothing.
+    def __init__(self, server):
+        self.keys = generate_keys()
+        self._tmp = tempfile.TemporaryDirectory()
+        public_key_file = os.path.join(self._tmp.name, 'loopback.pub')
+        with open(public_key_file, 'wb') as f:
+            f.write(serialize_public_key(self.keys.public))
+        self.context = zmq.Context()
+        server.bind('inproc://kybonet-replay', context=self.context)
+        server.add_subscriber('loopback', id_file=public_key_file)
+        self.client = KybonetClient()
+        self.client.connect_endpoint(
+                    'inproc://kybonet-replay', context=self.context,
+                    topic=fingerprint(self.keys.public))
+        self.events = 0
+
+    def drain(self, timeout=0):
+        client = self.client
+        while client.poll(timeout):
+            for events, trace, received, decrypted in \
+                    client.receive_all(self.keys.private):
+                if events:
+                    self.events += len(events)
+                    client.tracer.record(events, trace, received, decrypted,
+                                         time.time())
+            timeout = 0
+
+    def close(self):
+        self.context.destroy(linger=0)
+        self._tmp.cleanup()
+
+
+def main(args=None):
+    args = parse_args(args=args)
+
+    if args.quiet:
+        log_level = logging.ERROR
+    elif args.verbose:
+        log_level = logging.DEBUG
+    else:
+        log_level = logging.INFO
+    logging.basicConfig(level=log_level, format='%(levelname)s - %(message)s')
+
+    if not args.loopback and not args.public_key:
+        logger.error('A client public key (-i) is needed, or --loopback.')
+        return 1
+    try:
+        recording = Recording(args.recording)
+    except (OSError, RecordingError) as e:
+        logger.error(e)
+        return 1
+    for device in recording.devices.values():
+        logger.info('Device {}: "{}"'.format(device.index, device.name))
+
+    server = KybonetServer()
+    loopback = None
+    if args.loopback:
+        loopback = Loopback(server)
+    else:
+        server.connect(port=args.port)
+        server.add_subscriber('replay', id_file=args.public_key)
+    server.switch(0)
+
+    def idle():
+        server.flush_motion()
+        server.process_requests()
+        server.maintenance()
+        if loopback is not None:
+            loopback.client.ping()
+            loopback.drain()
+
+    deadline = time.monotonic() + args.delay
+    while time.monotonic() < deadline:
+        idle()
+        if loopback is not None and loopback.client.has_session:
+            break
+        time.sleep(0.01)
+
+    reads = events = 0
+    cpu0 = time.process_time()
+    t0 = time.perf_counter()
+    try:
+        for _ in range(args.repeat):
+            r, e = replay(server, recording, speed=args.speed, idle=idle)
+            reads += r
+            events += e
+    except KeyboardInterrupt:
+        pass
+    server.teardown()
+    wall = time.perf_counter() - t0
+    cpu = time.process_time() - cpu0
+    recording.close()
+
+    logger.info('Replayed {} events ({} reads) in {:.3f}s: {:.0f} events/s, '
+                '{:.1f} cpu us/event'.format(
+                    events, reads, wall, events / wall if wall else 0,
+                    cpu / events * 1e6 if events else 0))
+    if loopback is not None:
+        loopback.drain(timeout=100)
+        logger.info('Received {} events'.format(loopback.events))
+        for line in loopback.client.tracer.report():
+            logger.info('Latency: {}'.format(line))
+        loopback.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,17 +1,32 @@
 import argparse
-import json
-import yaml
+import asyncio
 import zmq
 import logging
-import shutil
+import signal
+import socket
+import threading
+import stat
 import sys
 import os
-from collections import defaultdict
+import time
+from collections import defaultdict, deque
 from selectors import DefaultSelector, EVENT_READ
 import kybonet
-from .input_devices import find_devices, RelativeMovement, PseudoEvent, \
-                           is_mouse, keycode_from_str
-from .crypto import import_public_key, encrypt
+from evdev import ecodes
+from .input_devices import PseudoEvent, EventBatch, DeviceProfile, \
+                           MotionCoalescer
+from .backends import EvdevInputs, SyntheticInputs
+from .hotkeys import Hotkeys, UnknownHotkey, InvalidHotkey
+from .pipeline import Stage, Lanes, LANE_KEYS, LANE_MOTION
+from .recording import Recorder
+from .crypto import import_public_key, encrypt, fingerprint, SessionKey
+from .protocol import ENCRYPTION_MODES, MSG_PING, MSG_EVENT, MSG_DATAGRAM, \
+                      MSG_KEY_STATE, MAX_FRAME_EVENTS, MAX_DATAGRAM_EVENTS, \
+                      pack_session_key, pack_event, pack_batch, \
+                      pack_key_state, \
+                      pack_json_payload, pack_trace, pack_pong, unpack_ping, \
+                      unpack_payload, \
+                      unpack_hello, verify_hello, message_kind, ProtocolError
 
 
 logger = logging.getLogger(__name__)
@@ -21,16 +36,58 @@ class DeviceNotFound(Exception):
     pass
 
 
-class UnknownHotkey(Exception):
+class UnknownSubscriber(Exception):
+    pass
+
+
+class InvalidGroup(Exception):
     pass
 
 
 def parse_args(args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--port', type=int, default=5555, help='Port.')
+    parser.add_argument('-u', '--udp-port', type=int, default=None,
+                        help='Send mouse motion as UDP datagrams on this '
+                        'port to the clients that ask for it (session '
+                        'encryption only).')
     parser.add_argument('-c', '--config', type=str,
                         default=None,
                         help='YML configuration file.')
+    runtime = parser.add_mutually_exclusive_group(required=False)
+    runtime.add_argument('-a', '--asyncio', action='store_true',
+                         help='Run on the asyncio event loop.')
+    runtime.add_argument('--pipeline', action='store_true',
+                         help='Read devices, process events and '
+                         'encrypt/send them in separate threads.')
+    parser.add_argument('--queue-size', type=int, default=256,
+                        help='Size of the queues between pipeline stages.')
+    parser.add_argument('--send-hwm', type=int, default=1000,
+                        help='Messages zmq queues for each client before '
+                        'the server queues them itself (default: 1000).')
+    parser.add_argument('--backlog-limit', type=int, default=256,
+                        help='Messages the server queues for a slow client '
+                        '(motion conflated) before keeping only its key '
+                        'state (default: 256).')
+    parser.add_argument('-s', '--stats-interval', type=float, default=0,
+                        help='Log pipeline stats every N seconds (they are '
+                        'also logged on SIGUSR1).')
+    parser.add_argument('--synthetic', action='store_true',
+                        help='Read synthetic devices instead of the ones in '
+                        'the config file (no /dev/input needed).')
+    parser.add_argument('--keyboard-rate', type=float, default=20,
+                        help='Keys per second typed by the synthetic '
+                        'keyboard (0: none).')
+    parser.add_argument('--mouse-rate', type=int, default=1000,
+                        help='Reports per second of the synthetic mouse (0: '
+                        'none).')
+    parser.add_argument('--record', type=str, default=None,
+                        help='Append the raw events read from the devices '
+                        'to this file (see kybonet-replay).')
+    parser.add_argument('--control', type=str, default=None,
+                        help='Unix socket for control commands (next, '
+                        'switch <name|group|index>, status, exit). Requires '
+                        '--asyncio.')
     verbosity = parser.add_mutually_exclusive_group(required=False)
     verbosity.add_argument('-q', '--quiet', action='store_true',
                            help='Reduce output messages.')
@@ -39,25 +96,93 @@ def parse_args(args=None):
     return parser.parse_args(args)
 
 
+class _AsyncLaneQueue(asyncio.Queue):
+    # asyncio.Queue with its items in Lanes: put((lane, barrier, item)).
+    def _init(self, maxsize):
+        self._queue = Lanes()
+
+
 class KybonetServer:
+    # Seconds without a hello from a client before its motion goes back to
+    # the reliable channel.
+    datagram_timeout = 10.0
+    # Seconds between key state snapshots sent to the current subscriber.
+    key_state_interval = 5.0
+    # Seconds between attempts to send the backlog of a slow subscriber.
+    backlog_retry = 0.01
+    # Seconds a slow subscriber must keep up before it's logged as caught up
+    # (and warned about again when it falls behind).
+    backlog_quiet = 5.0
 
-    def __init__(self):
+    def __init__(self, encryption='session', rekey_interval=300,
+                 announce_interval=1.0, coalescer=None, priority=True,
+                 send_hwm=1000, backlog_limit=256,
+                 inputs=None):
+        assert encryption in ENCRYPTION_MODES, \
+            'Unknown encryption mode: "{}"'.format(encryption)
         # zmq
         self._context = None
         self._socket = None
+        self._send_hwm = send_hwm
+        # datagram transport (motion only)
+        self._datagram = None
+        # crypto
+        self._encryption = encryption
+        self._rekey_interval = rekey_interval
+        self._announce_interval = announce_interval
         # subs
         self._subs = []
-        # devices
+        # messages queued for a slow subscriber (see _add_to_backlog)
+        self._backlog_limit = backlog_limit
+        # groups of subscribers the events are mirrored to
+        self._groups = []
+        self._group = None
+        # devices, from /dev/input unless other inputs are given (see
+        # backends)
+        self._inputs = EvdevInputs() if inputs is None else inputs
         self._devices_connected = []
         self._devices = []
+        self._profiles = {}
+        # names of the configured devices, followed when (re)plugged
+        self._wanted = []
+        self._watcher = None
         # hotkeys
-        self._hotkeys = self._empty_hotkeys()
+        self._hotkeys = Hotkeys()
+        self._hotkeys.add('switch', self.next)
+        self._hotkeys.add('exit', self.exit_program, ('Exit key pressed',))
         # run
         self._selector = DefaultSelector()
         # state
         self._current_idx = 0
         self._pressed_keys = defaultdict(lambda: False)
+        self._last_key_state = 0.0
         self._grabbed = False
+        # motion coalescing across reads (None: merge within a read only)
+        self._coalescer = coalescer
+        self._flush_handle = None
+        # keys and buttons ahead of motion (False: everything in order)
+        self._priority = priority
+        # reused for every read (reads are processed one at a time)
+        self._batch = EventBatch()
+        self._coalesced = EventBatch()
+        # (wall clock, monotonic) time of the device read being processed
+        self._read_stamp = None
+        self._recorder = None
+        # stats
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        # backpressure: messages queued, motion merged into the last queued
+        # message, motion dropped and backlogs replaced by the key state
+        self.backlogged = 0
+        self.conflated = 0
+        self.dropped = 0
+        self.overflows = 0
+        # asyncio runtime
+        self._send_queue = None
+        self._loop = None
+        # pipelined runtime
+        self._process_stage = None
+        self._send_stage = None
 
     @property
     def subs(self):
@@ -67,71 +192,232 @@ class KybonetServer:
     def devices(self):
         return self._devices
 
+    @property
+    def devices_connected(self):
+        # What scan_devices() found, opened or not.
+        return self._devices_connected
+
     def connect(self, port):
-        self._context = zmq.Context()
-        # ZMQ Socket Options: http://api.zeromq.org/4-2:zmq-setsockopt
-        # Send ZMTP heartbeats every 5000 ms.
-        self._context.setsockopt(zmq.HEARTBEAT_IVL, 5000)
-        self._socket = self._context.socket(zmq.PUB)
-        self._socket.bind("tcp://*:{}".format(port))
-
-    def add_subscriber(self, name, id_file=None, hotkey=None):
+        self.bind("tcp://*:{}".format(port))
+
+    def bind(self, endpoint, context=None):
+        if context is None:
+            context = zmq.Context()
+            # ZMQ Socket Options: http://api.zeromq.org/4-2:zmq-setsockopt
+            # Send ZMTP heartbeats every 5000 ms.
+            context.setsockopt(zmq.HEARTBEAT_IVL, 5000)
+        self._context = context
+        # XPUB works as PUB for the clients, but it also lets them send
+        # requests upstream (used for clock offset estimation).
+        self._socket = self._context.socket(zmq.XPUB)
+        self._socket.setsockopt(zmq.SNDHWM, self._send_hwm)
+        if self._encryption == 'session':
+            # A client that doesn't keep up must not make zmq drop its
+            # messages silently: with NODROP a send to a full queue fails
+            # instead (sends never block), and the server queues them
+            # itself. Subscriptions are applied by hand, only to the topic
+            # of a subscriber (see _handle_request), so the full queue is
+            # always one of the subscriber the message is for.
+            self._socket.setsockopt(zmq.XPUB_NODROP, 1)
+            self._socket.setsockopt(zmq.XPUB_MANUAL, 1)
+        # rsa clients all subscribe to everything: a full queue could be any
+        # of them, so as with PUB zmq drops the messages of a slow one.
+        self._socket.bind(endpoint)
+
+    def bind_datagram(self, port, host=''):
+        # Relative motion is sent to the clients that registered their
+        # address with a hello as datagrams: a lost or late one is simply
+        # dropped, instead of delaying everything queued behind it.
+        assert self._encryption == 'session', \
+            'Datagrams require session encryption'
+        self._datagram = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._datagram.bind((host, port))
+        self._datagram.setblocking(False)
+
+    def add_subscriber(self, name, id_file=None, hotkey=None, max_rate=None):
         new_sub = {'name': name, 'public_key': None, 'is_local': False,
-                   'hotkey': None}
+                   'hotkey': None, 'session': None, 'announced': 0,
+                   'topic': None, 'max_rate': max_rate,
+                   'address': None, 'address_seen': 0,
+                   'backlog': deque(), 'flushed': 0,
+                   'lagging': False, 'overflowed': False}
         if id_file is not None:
             with open(id_file, 'rb') as f:
                 key = import_public_key(f.read())
             new_sub['public_key'] = key
+            new_sub['topic'] = fingerprint(key)
             new_sub['is_local'] = False
         else:
             new_sub['is_local'] = True
         if hotkey:
             new_sub['hotkey'] = hotkey
-            k = 'switch_' + name
-            self._hotkeys[k] = {'key': keycode_from_str(hotkey),
-                                'callback': self.switch,
-                                'args': (len(self._subs),)}
+            self._hotkeys.add('switch_' + name, self.switch,
+                              (len(self._subs),), key=hotkey)
         self._subs.append(new_sub)
         logger.debug('Client added: {}.'.format(name))
 
+    def add_group(self, name, members, hotkey=None):
+        # Subscribers that receive the same events at once (mirror mode).
+        # members: names of subscribers already added; a local one means
+        # the devices aren't grabbed while the group is the target. Groups
+        # and subscribers share their names (and switch_<name> hotkeys).
+        if any(s['name'] == name for s in self._subs + self._groups) or \
+                'switch_' + name in self._hotkeys:
+            raise InvalidGroup('Group "{}" has the name of a subscriber, a '
+                               'group or a hotkey'.format(name))
+        subs = []
+        for member in members:
+            sub = next((s for s in self._subs if s['name'] == member), None)
+            if sub is None:
+                raise UnknownSubscriber('Unknown subscriber "{}" in group '
+                                        '"{}"'.format(member, name))
+            subs.append(sub)
+        new_group = {'name': name, 'hotkey': None,
+                     'targets': tuple(s for s in subs if not s['is_local']),
+                     'is_local': any(s['is_local'] for s in subs),
+                     'members': [s['name'] for s in subs]}
+        if hotkey:
+            new_group['hotkey'] = hotkey
+            self._hotkeys.add('switch_' + name, self.switch_group,
+                              (len(self._groups),), key=hotkey)
+        self._groups.append(new_group)
+        logger.debug('Group added: {} ({}).'.format(
+                        name, ', '.join(new_group['members'])))
+
+    @property
+    def groups(self):
+        return self._groups
+
     def scan_devices(self):
-        self._devices_connected = find_devices()
+        # Only reads sysfs, devices are opened when added.
+        self._devices_connected = self._inputs.list()
 
     def add_device(self, name):
-        for d in self._devices_connected:
-            if name == d.name:
-                self._devices.append(d)
-                logger.debug('Found device "{}"'.format(name))
+        if name not in self._wanted:
+            self._wanted.append(name)
+        for info in self._devices_connected:
+            if name == info.name:
+                device = self._open_device(info)
+                logger.debug('Found device "{}" ({})'.format(
+                                name, self.profile(device).role))
                 return
         raise DeviceNotFound('Device "{}" not present.'.format(name))
 
-    def _empty_hotkeys(self):
-        return {'switch': {'key': None,
-                           'callback': self.next,
-                           'args': ()},
-                'exit': {'key': None,
-                         'callback': self.exit_program,
-                         'args': ('Exit key pressed',)},}
+    def remove_device(self, device):
+        # Returns False if the device was already removed. The keys held on
+        # it are released, whatever noticed it was gone.
+        if device not in self._devices:
+            return False
+        self._devices.remove(device)
+        try:
+            self._selector.unregister(device)
+        except (KeyError, ValueError):
+            pass
+        try:
+            device.close()
+        except OSError:
+            pass
+        logger.info('Device "{}" disconnected.'.format(device.name))
+        if self._process_stage is not None and \
+                not self._process_stage.is_current():
+            # The pipeline reader: the process stage forgets it after the
+            # reads of the device that are still queued.
+            self._process_stage.put((device, None, None), self._lane(device))
+        else:
+            self._forget_device(device)
+        return True
+
+    def _forget_device(self, device):
+        profile = self._profiles.pop(id(device), None)
+        if profile is not None:
+            self._release_pressed_keys({code for etype, code in profile.accept
+                                        if etype == ecodes.EV_KEY})
+
+    def watch_devices(self):
+        # Follow the configured devices when they are unplugged and plugged
+        # again while running.
+        try:
+            self._watcher = self._inputs.watcher()
+        except OSError as e:
+            logger.warning('Hotplug disabled: {}'.format(e))
+
+    def hotplug(self):
+        # Handles the pending hotplug notifications. Returns the devices
+        # added, so the runtime can start reading them.
+        added = []
+        for action, path in self._watcher.read():
+            device = next((d for d in self._devices if d.path == path), None)
+            if action == 'remove':
+                if device is not None:
+                    self.remove_device(device)
+                continue
+            if device is not None:
+                continue
+            info = self._inputs.info(path)
+            if info is None or info.name not in self._wanted or \
+                    any(d.name == info.name for d in self._devices):
+                continue
+            try:
+                device = self._open_device(info)
+            except OSError:
+                # Permissions not set yet, retried on the next IN_ATTRIB.
+                continue
+            if self._grabbed:
+                try:
+                    device.grab()
+                except OSError as e:
+                    logger.warning('Unable to grab "{}": {}'.format(
+                                        info.name, e))
+            logger.info('Device "{}" connected.'.format(info.name))
+            added.append(device)
+        return added
+
+    def _open_device(self, info):
+        device = info.open()
+        self._devices.append(device)
+        self._profiles[id(device)] = DeviceProfile.from_capabilities(
+                                                        info.capabilities)
+        return device
+
+    def _read_events(self, device):
+        # None if the device is gone (unplugged).
+        try:
+            return list(device.read())
+        except BlockingIOError:
+            return []
+        except OSError as e:
+            logger.warning('Device "{}" lost: {}'.format(device.name, e))
+            self.remove_device(device)
+            return None
 
     def assign_hotkey(self, name, key):
-        assert name in self._hotkeys, 'Unknown hotkey: "{}"'.format(name)
-        if isinstance(key, int):
-            keycode = key
-        elif isinstance(key, str):
-            keycode = keycode_from_str(key)
-        assert isinstance(keycode, int), 'Invalid key: "{}"'.format(key)
-        self._hotkeys[name]['key'] = keycode
+        # key: keycode, key name ('f7') or chord ('ctrl+alt+1').
+        self._hotkeys.assign(name, key)
+
+    def record(self, path):
+        self._recorder = Recorder(path)
+        logger.info('Recording to {}'.format(path))
+
+    def stop_recording(self):
+        if self._recorder is None:
+            return
+        self._recorder.close()
+        logger.info('Recorded {} events ({} reads) to {}'.format(
+                        self._recorder.events, self._recorder.reads,
+                        self._recorder.path))
+        self._recorder = None
 
     def teardown(self):
         logger.debug('Teardown')
-        for k, pressed in self._pressed_keys.items():
-            if pressed:
-                new_event = PseudoEvent.KeyRelease(k)
-                self.send_event(new_event)
+        self.stop_recording()
+        self._leave_targets()
+        self._flush_send_queue()
         self.ungrab_all()
-        for d in self._devices:
-            self._selector.unregister(d)
+        for key in list(self._selector.get_map().values()):
+            self._selector.unregister(key.fileobj)
         self._selector.close()
+        if self._watcher is not None:
+            self._watcher.close()
 
     def exit_program(self, reason='-'):
         self.teardown()
@@ -145,19 +431,54 @@ class KybonetServer:
     def switch(self, idx):
         if idx < len(self._subs):
             self._current_idx = idx
-            if self.current_sub['is_local']:
-                self.ungrab_all()
-            else:
-                self.grab_all()
+            self._group = None
+            self._retarget(self.current_sub['is_local'])
             logger.info('Current sub: {} ({})'.format(
                 self.current_sub['name'], self._current_idx,))
         else:
             logger.warning('Ignoring invalid sub: {}'.format(idx))
 
+    def switch_group(self, idx):
+        if idx < len(self._groups):
+            self._group = self._groups[idx]
+            self._retarget(self._group['is_local'])
+            logger.info('Current group: {} ({})'.format(
+                self._group['name'], ', '.join(self._group['members'])))
+        else:
+            logger.warning('Ignoring invalid group: {}'.format(idx))
+
+    def _retarget(self, local):
+        targets = self.targets
+        # Announce the session keys with the first event sent to them.
+        for sub in targets:
+            sub['announced'] = 0
+        if self._coalescer is not None:
+            # A group goes at the pace of its slowest member.
+            rates = [s['max_rate'] for s in targets if s['max_rate']]
+            self._coalescer.floor = 1.0 / min(rates) if rates else 0.0
+        if local:
+            self.ungrab_all()
+        else:
+            self.grab_all()
+        self._send_key_state()
+
     @property
     def current_sub(self):
         return self._subs[self._current_idx]
 
+    @property
+    def current_group(self):
+        # The group the events are mirrored to, None for a single sub.
+        return self._group
+
+    @property
+    def targets(self):
+        # The remote subscribers the events go to.
+        if self._group is not None:
+            return self._group['targets']
+        sub = self.current_sub
+        return () if sub['is_local'] else (sub,)
+
     def grab_all(self):
         if self._grabbed:
             return
@@ -172,94 +493,818 @@ class KybonetServer:
         for d in self._devices:
             d.ungrab()
 
-    def merge_events(self, events):
-        merged_events = []
-        rel_movement = RelativeMovement()
-        for e in events:
-            if e.is_rel_movement():
-                x, y, wheel = e.get_rel_movement()
-                if rel_movement.is_mergeable(x, y, wheel):
-                    rel_movement.merge(x, y, wheel)
-                else:
-                    merged_events += rel_movement.generate_events()
-                    rel_movement.set(x, y, wheel)
-            else:
-                merged_events += rel_movement.generate_events()
-                rel_movement.set(0, 0, 0)
-                merged_events.append(e)
-        merged_events += rel_movement.generate_events()
-        rel_movement.set(0, 0, 0)
-        return merged_events
-
-    def event_is_hotkey(self, event):
-        for name, hotkey in self._hotkeys.items():
-            if hotkey['key'] == event.code:
-                return True
-        return False
-
-    def run_hotkey_callback(self, event):
-        for name, hotkey in self._hotkeys.items():
-            # key, callback, args
-            if hotkey['key'] == event.code:
-                hotkey['callback'](*hotkey['args'])
-                return
-        raise UnknownHotkey('Key code {} is not a valid hotkey'.format(
-                                                                event.ecode))
+    def profile(self, device):
+        profile = self._profiles.get(id(device))
+        if profile is None:
+            profile = DeviceProfile.from_device(device)
+            self._profiles[id(device)] = profile
+        return profile
+
+    def feed(self, device, events, stamp=None):
+        # Events read from a device, stamp: (wall clock, monotonic) time of
+        # the read.
+        self._read_stamp = stamp
+        self.parse_events(device, events)
+        self._read_stamp = None
 
     def parse_events(self, device, events):
-        events = [PseudoEvent.from_event(e) for e in events]
-        if is_mouse(device):
-            events = [e for e in events if e.is_valid_mouse_event()]
-            events = self.merge_events(events)
-        else:
-            events = [e for e in events if e.is_valid_keyboard_event()]
-            events = [e for e in events if (
-                        not(e.is_key_pressed() and self.event_is_hotkey(e)))]
-        for event in events:
-            if self.event_is_hotkey(event) and event.is_key_released():
-                logger.debug('Hotkey detected ({})'.format(event.code))
-                for k, pressed in self._pressed_keys.items():
-                    if pressed:
-                        new_event = PseudoEvent.KeyRelease(k)
-                        self._send_event(new_event)
-                self.run_hotkey_callback(event)
+        if self._recorder is not None:
+            read_time = self._read_stamp[0] if self._read_stamp else \
+                        time.time()
+            self._recorder.record(device, events, read_time)
+        profile = self.profile(device)
+        batch = profile.load(self._batch, events)
+        # Only the devices with motion flush the pending motion, a keyboard
+        # goes ahead of it.
+        pointer = profile.merge_motion
+        if pointer and self._coalescer is not None:
+            batch = self.coalesce(batch)
+        elif pointer:
+            batch.merge_motion()
+        if not profile.has_keys:
+            self._send_batch(batch, pointer=pointer)
+            return
+        # Everything from one read is sent as a single frame, except when a
+        # hotkey is found: events before it go to the current subscriber.
+        # The key completing a chord is swallowed (the events after it are
+        # moved back over it), and the hotkey runs when it's released.
+        feed_key = self._hotkeys.feed_key
+        etypes, codes, values = batch.etypes, batch.codes, batch.values
+        ev_key = ecodes.EV_KEY
+        start = end = 0
+        for i in range(len(batch)):
+            hotkey = None
+            if etypes[i] == ev_key:
+                hotkey = feed_key(codes[i], values[i])
+            if hotkey is None:
+                if i != end:
+                    batch.move(i, end)
+                end += 1
+            elif values[i] == 0:
+                logger.debug('Hotkey detected ({})'.format(hotkey.name))
+                self._send_batch(batch, start, end, pointer)
+                start = end
+                self._leave_targets()
+                hotkey.run()
+        self._send_batch(batch, start, end, pointer)
+
+    def coalesce(self, batch, now=None):
+        # Motion is held back up to the coalescing window. Any other event
+        # flushes the pending motion first, so the order is kept. Returns a
+        # batch reused by the next call.
+        if now is None:
+            now = time.monotonic()
+        coalescer = self._coalescer
+        coalesced = self._coalesced.clear()
+        if coalescer.due(now):
+            coalescer.flush_into(coalesced)
+        etypes, codes, values, times = (batch.etypes, batch.codes,
+                                        batch.values, batch.times)
+        ev_rel = ecodes.EV_REL
+        rel_x, rel_y, rel_wheel = ecodes.REL_X, ecodes.REL_Y, ecodes.REL_WHEEL
+        for i in range(len(batch)):
+            if etypes[i] == ev_rel:
+                code = codes[i]
+                value = values[i]
+                coalescer.add(value if code == rel_x else 0,
+                              value if code == rel_y else 0,
+                              value if code == rel_wheel else 0,
+                              times[i], now, coalesced)
             else:
-                self._send_event(event)
-        return
+                coalescer.flush_into(coalesced)
+                coalesced.append(etypes[i], codes[i], values[i], times[i])
+        if coalescer.due(now):
+            coalescer.flush_into(coalesced)
+        elif coalescer.pending:
+            self._schedule_motion_flush()
+        return coalesced
+
+    def flush_motion(self, force=False):
+        self._flush_handle = None
+        if self._coalescer is None:
+            return
+        if force or self._coalescer.due(time.monotonic()):
+            self._send_events(self._coalescer.flush())
 
-    def _send_event(self, event):
-        if self.current_sub['is_local']:
+    def _motion_timeout(self, default):
+        if self._coalescer is None:
+            return default
+        return self._coalescer.timeout(time.monotonic(), default)
+
+    def _schedule_motion_flush(self):
+        # The selector loop and the pipeline recompute their timeouts after
+        # every read; the asyncio loop needs a timer.
+        if self._loop is None or self._flush_handle is not None:
+            return
+        self._flush_handle = self._loop.call_later(
+                                self._motion_timeout(0), self.flush_motion)
+
+    def _leave_targets(self):
+        # Before the targets change (or the server stops): the motion held
+        # back and the releases of the keys held go to the current ones.
+        self.flush_motion(force=True)
+        self._release_pressed_keys()
+
+    def _release_pressed_keys(self, codes=None):
+        # codes: only release these (e.g. the keys of a device that's gone).
+        held = [k for k, pressed in list(self._pressed_keys.items())
+                if pressed and (codes is None or k in codes)]
+        if self._encryption == 'rsa':
+            # Legacy clients only understand events.
+            self._send_events([PseudoEvent.KeyRelease(k) for k in held])
+            return
+        if codes is None:
+            self._pressed_keys.clear()
+        elif held:
+            for k in held:
+                self._pressed_keys[k] = False
+        else:
+            return
+        self._send_key_state()
+
+    def _send_key_state(self):
+        # One message with every key held, whatever the number of keys; the
+        # client releases the ones it holds that aren't in it. The keys are
+        # those of this server, so every member of a group gets the same.
+        targets = self.targets
+        if self._encryption == 'rsa' or not targets or self._socket is None:
+            return
+        self._last_key_state = time.monotonic()
+        pressed = [k for k, down in list(self._pressed_keys.items()) if down]
+        self._dispatch(targets, pack_key_state(pressed), MSG_KEY_STATE)
+
+    def _send_events(self, events):
+        if events:
+            self._send_batch(EventBatch.from_events(events))
+
+    def _send_batch(self, batch, start=0, end=None, pointer=False):
+        # pointer: the events come from a device with motion, so a frame with
+        # keys or buttons must not overtake the motion queued before it.
+        end = len(batch) if end is None else end
+        if start >= end:
+            return
+
+        targets = self.targets
+        if not targets:
             logger.debug('Local user, nothing done...')
             return
 
-        if event.is_key_pressed() and self._pressed_keys[event.code]:
+        end = self._track_pressed_keys(batch, start, end)
+        if start == end:
+            return
+
+        motion = batch.is_motion(start, end)
+        lane = LANE_MOTION if motion else LANE_KEYS
+        if self._encryption == 'rsa':
+            # Legacy clients expect one event per message.
+            for event in batch.events(start, end):
+                self._dispatch(targets, pack_json_payload(event),
+                               lane=lane, barrier=pointer)
             return
 
-        if event.is_key_pressed():
-            self._pressed_keys[event.code] = True
-        elif event.is_key_released():
-            self._pressed_keys[event.code] = False
+        # Members of a group without a datagram address get it through the
+        # reliable channel (see _channel).
+        if motion and end - start <= MAX_DATAGRAM_EVENTS and \
+                any(self._datagram_address(s) for s in targets):
+            self._dispatch(targets, pack_batch(batch, start, end),
+                           MSG_DATAGRAM, LANE_MOTION)
+            return
+
+        for i in range(start, end, MAX_FRAME_EVENTS):
+            payload = pack_batch(batch, i, min(i + MAX_FRAME_EVENTS, end))
+            self._dispatch(targets, payload, lane=lane, barrier=pointer)
+
+    def _track_pressed_keys(self, batch, start, end):
+        # Keeps _pressed_keys up to date and drops the presses of keys that
+        # are already pressed, moving the events after them back. Returns the
+        # new end.
+        etypes, codes, values = batch.etypes, batch.codes, batch.values
+        pressed = self._pressed_keys
+        ev_key = ecodes.EV_KEY
+        j = start
+        for i in range(start, end):
+            if etypes[i] == ev_key:
+                code = codes[i]
+                value = values[i]
+                if value == 1:
+                    if pressed[code]:
+                        continue
+                    pressed[code] = True
+                elif value == 0:
+                    pressed[code] = False
+            if i != j:
+                batch.move(i, j)
+            j += 1
+        return j
+
+    def _datagram_address(self, sub):
+        if sub['address'] is None or time.monotonic() - \
+                sub['address_seen'] > self.datagram_timeout:
+            return None
+        return sub['address']
+
+    def _dispatch(self, subs, payload, kind=MSG_EVENT, lane=LANE_KEYS,
+                  barrier=False):
+        # subs: the subscribers the payload is encrypted for (a group sends
+        # one item for all its members). lane, barrier: priority in the send
+        # queue (see pipeline.Lanes).
+        item = (subs, payload, self._read_stamp, kind)
+        if self._send_stage is not None and self._send_stage.is_current():
+            # From the send stage itself (maintenance): queueing could wait
+            # forever on its own full queue.
+            self._publish(*item)
+        elif self._send_stage is not None:
+            self._send_stage.put(item, lane, barrier)
+        elif self._send_queue is not None:
+            self._send_queue.put_nowait((lane, barrier, item)
+                                        if self._priority else item)
+        else:
+            self._publish(*item)
+
+    def _flush_send_queue(self):
+        if self._send_stage is not None:
+            self._send_stage.stop()
+        if self._send_queue is not None:
+            while not self._send_queue.empty():
+                self._publish(*self._send_queue.get_nowait())
+
+    def _publish(self, subs, payload, read_stamp=None, kind=MSG_EVENT):
+        start = time.perf_counter()
+        for sub in subs:
+            self._encrypt_and_send(sub, payload, read_stamp,
+                                   self._channel(sub, kind))
+        if self._coalescer is not None:
+            self._coalescer.record_cost(time.perf_counter() - start)
+
+    def _encrypt_and_send(self, sub, payload, read_stamp, kind=MSG_EVENT):
+        # kind: MSG_EVENT, MSG_KEY_STATE or MSG_DATAGRAM (sent as a datagram),
+        # only MSG_EVENT in rsa mode. While the subscriber has a backlog
+        # everything goes behind it, so nothing is reordered.
+        if sub['backlog'] and not self._flush_backlog(sub):
+            self._add_to_backlog(sub, payload, read_stamp, kind)
+        elif not self._send_payload(sub, payload, read_stamp, kind):
+            self._add_to_backlog(sub, payload, read_stamp, kind)
+
+    def _channel(self, sub, kind):
+        # Datagrams only to the subscribers with a datagram address.
+        if kind == MSG_DATAGRAM and self._datagram_address(sub) is None:
+            return MSG_EVENT
+        return kind
+
+    def _send_payload(self, sub, payload, read_stamp, kind):
+        # False if the subscriber can't take it now (see _add_to_backlog).
+        if self._encryption == 'rsa':
+            message = encrypt(message=payload, public_key=sub['public_key'])
+            return self._send_frames([message])
+        session = self._session(sub)
+        if session is None:
+            return False
+        message = pack_event(session, payload, kind)
+        if read_stamp is None:
+            read, read_mono = time.time(), time.monotonic()
+        else:
+            read, read_mono = read_stamp
+        # The send call can't be timed in the message it sends: its time is
+        # part of the network stage.
+        trace = pack_trace(read, time.monotonic() - read_mono)
+        if kind == MSG_DATAGRAM:
+            self._send_datagram(sub, message + trace)
+            return True
+        return self._send_to(sub, message, trace)
+
+    def _add_to_backlog(self, sub, payload, read_stamp, kind):
+        # The zmq queue of the subscriber is full: its messages are kept
+        # unencrypted until it catches up (they are encrypted when sent, with
+        # the session key of the time). Keys are never dropped. Motion is
+        # merged into the message queued last when that one is motion too,
+        # so a slow client gets the same displacement in fewer messages, and
+        # a newer key state replaces a queued one. A full backlog drops its
+        # motion first; if it's still full, everything in it is replaced by
+        # the key state (releases included, the client ends up holding the
+        # keys held here). Only in session mode: rsa sends never fail.
+        backlog = sub['backlog']
+        if not sub['lagging']:
+            logger.warning('{} is not keeping up, queueing its events.'.format(
+                                sub['name']))
+            sub['lagging'] = True
+        if kind == MSG_DATAGRAM:
+            # Behind the backlog anyway: through the reliable channel.
+            kind = MSG_EVENT
+        if backlog:
+            last_payload, last_stamp, last_kind = backlog[-1]
+            merged = None
+            if kind == last_kind == MSG_KEY_STATE:
+                merged = payload
+            elif kind == last_kind == MSG_EVENT:
+                merged = self._conflate_motion(last_payload, payload)
+            if merged is not None:
+                backlog[-1] = (merged, last_stamp, kind)
+                self.conflated += 1
+                return
+        if len(backlog) >= self._backlog_limit:
+            self._overflow(sub)
+        backlog.append((payload, read_stamp, kind))
+        self.backlogged += 1
+
+    @staticmethod
+    def _motion_events(payload):
+        # The events of a frame with relative motion only, otherwise None.
+        try:
+            events = unpack_payload(payload)
+        except ProtocolError:
+            return None
+        if all(e.is_rel_movement() for e in events):
+            return events
+        return None
+
+    def _conflate_motion(self, first, second):
+        # One frame with the summed motion of two motion frames (one event
+        # per axis, with the time of the first one), or None.
+        events = self._motion_events(first)
+        if events is None:
+            return None
+        more = self._motion_events(second)
+        if more is None:
+            return None
+        events += more
+        totals = defaultdict(int)
+        for event in events:
+            totals[event.code] += event.value
+        batch = EventBatch()
+        t = events[0].time if events else time.time()
+        for code in sorted(totals):
+            if totals[code]:
+                batch.append(ecodes.EV_REL, code, totals[code], t)
+        return pack_batch(batch)
+
+    def _overflow(self, sub):
+        backlog = sub['backlog']
+        kept = [entry for entry in backlog
+                if entry[2] != MSG_EVENT or
+                self._motion_events(entry[0]) is None]
+        self.dropped += len(backlog) - len(kept)
+        if len(kept) >= self._backlog_limit:
+            if not sub['overflowed']:
+                logger.warning('Backlog of {} full, only its key state is '
+                               'kept.'.format(sub['name']))
+                sub['overflowed'] = True
+            pressed = [k for k, down in list(self._pressed_keys.items())
+                       if down]
+            kept = [(pack_key_state(pressed), None, MSG_KEY_STATE)]
+            self.overflows += 1
+        # In place: the caller appends to it.
+        backlog.clear()
+        backlog.extend(kept)
+
+    def _flush_backlog(self, sub):
+        # Sends what's queued for the subscriber, in order, until its queue
+        # is full again. True when the backlog is empty. Tried at most every
+        # backlog_retry seconds: a failed send costs an encryption, and
+        # meanwhile new motion is merged into the backlog.
+        backlog = sub['backlog']
+        now = time.monotonic()
+        if now - sub['flushed'] < self.backlog_retry:
+            return False
+        sub['flushed'] = now
+        while backlog:
+            payload, read_stamp, kind = backlog[0]
+            if not self._send_payload(sub, payload, read_stamp, kind):
+                return False
+            backlog.popleft()
+        return True
 
-        fields = ['etype', 'code', 'value', 'time']
-        event_dict = {k: getattr(event, k) for k in fields}
-        to_send_str = json.dumps(event_dict)
-        encrypted = encrypt(message=to_send_str.encode('utf-8'),
-                            public_key=self.current_sub['public_key'])
-        self._socket.send(encrypted)
+    def _flush_backlogs(self):
+        now = time.monotonic()
+        for sub in self._subs:
+            if sub['backlog']:
+                self._flush_backlog(sub)
+            elif sub['lagging'] and \
+                    now - sub['flushed'] >= self.backlog_quiet:
+                logger.info('{} caught up.'.format(sub['name']))
+                sub['lagging'] = sub['overflowed'] = False
+
+    def _backlog_timeout(self, default):
+        if any(sub['backlog'] for sub in self._subs):
+            return min(default, self.backlog_retry)
+        return default
+
+    def _send_datagram(self, sub, data):
+        try:
+            self._datagram.sendto(data, sub['address'])
+            self.messages_sent += 1
+            self.bytes_sent += len(data)
+        except OSError as e:
+            # Full buffer or unreachable: same as lost on the way.
+            logger.debug('Datagram to {} dropped: {}'.format(sub['name'], e))
+
+    def _send_to(self, sub, message, trace=None):
+        # The topic frame is the fingerprint of the subscriber public key.
+        # Clients only subscribe to their own fingerprint, so zmq filters the
+        # messages (on the publisher side for tcp) before any crypto runs.
+        frames = [sub['topic'], message]
+        if trace is not None:
+            frames.append(trace)
+        return self._send_frames(frames)
+
+    def _send_frames(self, frames):
+        # False if a subscriber's queue is full (nothing is sent).
+        try:
+            self._socket.send_multipart(frames, flags=zmq.NOBLOCK)
+        except zmq.Again:
+            return False
+        self.messages_sent += 1
+        self.bytes_sent += sum(len(f) for f in frames)
+        return True
+
+    def process_requests(self):
+        # Upstream messages from the clients. Subscriptions (first byte 0 or
+        # 1) are handled by zmq, only pings are answered.
+        while self._socket.poll(0):
+            self._handle_request(self._socket.recv())
+        self.process_datagram_requests()
+
+    def process_datagram_requests(self):
+        if self._datagram is None:
+            return
+        while True:
+            try:
+                data, address = self._datagram.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            self._handle_hello(data, address)
+
+    def _handle_hello(self, data, address):
+        # A client registering (or refreshing) the address its datagrams go
+        # to. It's sealed with its session key, so the address can't be
+        # changed by anyone else.
+        try:
+            topic, key_id = unpack_hello(data)
+        except ProtocolError:
+            return
+        for sub in self._subs:
+            session = sub['session']
+            if sub['topic'] != topic or session is None or \
+                    session.key_id != key_id:
+                continue
+            try:
+                verify_hello(data, session)
+            except ValueError:
+                return
+            if sub['address'] != address:
+                logger.debug('Datagrams for {} go to {}.'.format(
+                                sub['name'], address))
+            sub['address'] = address
+            sub['address_seen'] = time.monotonic()
+            return
+
+    def _handle_request(self, message):
+        if message[:1] in (b'\x00', b'\x01'):
+            self._handle_subscription(message[:1] == b'\x01', message[1:])
+            return
+        if message_kind(message) != MSG_PING:
+            return
+        try:
+            topic, client_time = unpack_ping(message)
+        except ProtocolError:
+            return
+        if any(topic == s['topic'] for s in self._subs if s['topic']):
+            # Dropped if the client is backlogged, it pings again.
+            self._send_frames([topic, pack_pong(client_time, time.time())])
+
+    def _handle_subscription(self, subscribe, topic):
+        subs = [s for s in self._subs if s['topic'] == topic]
+        if self._encryption == 'session' and subs:
+            # XPUB_MANUAL: for the client that just sent it.
+            self._socket.setsockopt(
+                zmq.SUBSCRIBE if subscribe else zmq.UNSUBSCRIBE, topic)
+        if subscribe:
+            # A client (re)subscribed: announce its session key right away
+            # instead of waiting for the next periodic announcement.
+            for sub in subs:
+                sub['announced'] = 0
+
+    def maintenance(self):
+        # Rotates and re-announces the session key of the current subscriber
+        # when due, so it's done while idle and not only in the event path.
+        # The backlogs of slow subscribers are sent from here too.
+        self._flush_backlogs()
+        targets = self.targets
+        if self._encryption != 'session' or not targets:
+            return
+        for sub in targets:
+            self._session(sub)
+        # Also repeats the key state now and then, for the clients that
+        # connected late or missed a release.
+        if time.monotonic() - self._last_key_state > self.key_state_interval:
+            self._send_key_state()
+
+    def _session(self, sub):
+        # The RSA keys are only used to hand each subscriber its symmetric
+        # session key. The key is re-announced periodically so clients that
+        # connect late can pick it up, and rotated after rekey_interval
+        # seconds or when its counter is about to be exhausted. None if the
+        # key is due but can't be announced now (backpressure), as messages
+        # encrypted with it could not be decrypted.
+        session = sub['session']
+        if (session is None or session.age() > self._rekey_interval or
+                session.messages >= session.max_messages):
+            session = SessionKey.generate()
+            sub['session'] = session
+            sub['announced'] = 0
+            logger.debug('New session key for {}.'.format(sub['name']))
+        now = time.monotonic()
+        if now - sub['announced'] > self._announce_interval:
+            if not self._send_to(sub, pack_session_key(session,
+                                                       sub['public_key'])):
+                return None
+            sub['announced'] = now
+        return session
 
     def run(self):
         for d in self._devices:
             self._selector.register(d, EVENT_READ)
+        # The zmq fd is edge triggered, so requests are also checked after
+        # every iteration and at least once per second.
+        self._selector.register(self._socket, EVENT_READ)
+        if self._datagram is not None:
+            self._selector.register(self._datagram, EVENT_READ)
+        if self._watcher is not None:
+            self._selector.register(self._watcher, EVENT_READ)
+
+        self.switch(idx=0)
+        try:
+            while True:
+                timeout = self._motion_timeout(self._backlog_timeout(1.0))
+                reads = []
+                for key, mask in self._selector.select(timeout=timeout):
+                    device = key.fileobj
+                    if device is self._socket or device is self._datagram:
+                        continue
+                    if device is self._watcher:
+                        for d in self.hotplug():
+                            self._selector.register(d, EVENT_READ)
+                        continue
+                    events = self._read_events(device)
+                    if events is None:
+                        continue
+                    reads.append((device, events,
+                                  (time.time(), time.monotonic())))
+                if self._priority:
+                    # Keys and buttons before the pure motion read with
+                    # them, in the order they were read otherwise.
+                    reads.sort(key=lambda read: self._read_lane(*read[:2]))
+                for device, events, stamp in reads:
+                    self.feed(device, events, stamp)
+                self.flush_motion()
+                self.process_requests()
+                self.maintenance()
+        except KeyboardInterrupt:
+            pass
 
+    def run_pipelined(self, queue_size=256, stats_interval=0):
+        # reader (this thread) -> process -> crypto + send
+        # The reader only drains the devices and timestamps the reads, so
+        # the kernel buffers don't overflow while encrypting. Hotkeys and
+        # pressed keys are only handled by the process stage, and only the
+        # send stage touches the zmq socket.
+        self._process_stage = Stage('process', self._process_read,
+                                    maxsize=queue_size,
+                                    idle=self.flush_motion,
+                                    idle_interval=lambda:
+                                        self._motion_timeout(0.5),
+                                    lanes=self._priority)
+        self._send_stage = Stage('send', self._publish, maxsize=queue_size,
+                                 idle=self._send_idle,
+                                 idle_interval=lambda:
+                                     self._backlog_timeout(0.5),
+                                 lanes=self._priority)
+        for d in self._devices:
+            self._selector.register(d, EVENT_READ)
+        if self._watcher is not None:
+            self._selector.register(self._watcher, EVENT_READ)
         self.switch(idx=0)
+        self._process_stage.start()
+        self._send_stage.start()
+        report_requested = []
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1,
+                          lambda signum, frame: report_requested.append(True))
+        last_report = time.monotonic()
         try:
             while True:
-                for key, mask in self._selector.select():
+                for key, mask in self._selector.select(timeout=1.0):
                     device = key.fileobj
-                    events = list(device.read())
-                    self.parse_events(device, events)
+                    if device is self._watcher:
+                        for d in self.hotplug():
+                            self._selector.register(d, EVENT_READ)
+                        continue
+                    # A device lost is removed here and forgotten by the
+                    # process stage (see remove_device). Only pure motion
+                    # is overtaken: a read with keys or buttons from a
+                    # pointer, or one that may run a hotkey (a switch),
+                    # waits for the reads queued before it in the other
+                    # lanes, so the reads of a device stay in order and a
+                    # click keeps its modifiers.
+                    events = self._read_events(device)
+                    if events is None:
+                        continue
+                    stamp = (time.time(), time.monotonic())
+                    lane = self._read_lane(device, events)
+                    barrier = lane != self._lane(device) or \
+                        self._may_run_hotkey(events)
+                    self._process_stage.put((device, events, stamp), lane,
+                                            barrier)
+                if report_requested or (stats_interval and
+                                        time.monotonic() - last_report >
+                                        stats_interval):
+                    del report_requested[:]
+                    for line in self.pipeline_stats():
+                        logger.info('Pipeline: {}'.format(line))
+                    last_report = time.monotonic()
+        except KeyboardInterrupt:
+            pass
+
+    def _may_run_hotkey(self, events):
+        ev_key = ecodes.EV_KEY
+        return any(e.type == ev_key and self._hotkeys.is_trigger(e.code)
+                   for e in events)
+
+    def _lane(self, device):
+        # Keyboards first: their reads never have to wait for motion.
+        profile = self._profiles.get(id(device))
+        if profile is not None and profile.has_keys and \
+                not profile.merge_motion:
+            return LANE_KEYS
+        return LANE_MOTION
+
+    def _read_lane(self, device, events):
+        # Keys and buttons keep their order: only the reads of a pointer
+        # without them (pure motion) are in the motion lane.
+        lane = self._lane(device)
+        if lane == LANE_MOTION and \
+                any(e.type == ecodes.EV_KEY for e in events):
+            return LANE_KEYS
+        return lane
+
+    def pipeline_stats(self):
+        return [stage.stats() for stage in (self._process_stage,
+                                            self._send_stage)
+                if stage is not None] + [self.backlog_stats()]
+
+    def backlog_stats(self):
+        pending = sum(len(sub['backlog']) for sub in self._subs)
+        return 'backlog: pending={} queued={} conflated={} dropped={} ' \
+               'overflows={}'.format(pending, self.backlogged, self.conflated,
+                                     self.dropped, self.overflows)
+
+    def _process_read(self, device, events, stamp):
+        if events is None:
+            # Queued by remove_device.
+            self._forget_device(device)
+            return
+        if id(device) not in self._profiles:
+            # Read before the device was removed and forgotten: it's closed,
+            # profile() can't read its capabilities any more.
+            return
+        self.feed(device, events, stamp)
+
+    def _send_idle(self):
+        self.process_requests()
+        self.maintenance()
+
+    def run_async(self, control_path=None):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._run_async(control_path))
         except KeyboardInterrupt:
             pass
+        finally:
+            loop.close()
+
+    async def _run_async(self, control_path=None):
+        # Device readers, the send path, requests from the clients, timers
+        # and the control channel run as tasks. Sends stay on the regular
+        # socket (they never block); the asyncio socket shadows it to wait
+        # for requests.
+        self._send_queue = _AsyncLaneQueue() if self._priority else \
+            asyncio.Queue()
+        self._loop = asyncio.get_event_loop()
+        self.switch(idx=0)
+        if self._watcher is not None:
+            self._loop.add_reader(self._watcher, self._hotplug_async)
+        if self._datagram is not None:
+            self._loop.add_reader(self._datagram,
+                                  self.process_datagram_requests)
+        tasks = [self._read_device(d) for d in self._devices]
+        tasks += [self._send_loop(), self._serve_requests(),
+                  self._timer(self.maintenance,
+                              lambda: self._backlog_timeout(0.5))]
+        if control_path:
+            if stat.S_ISSOCK(os.stat(control_path).st_mode
+                             if os.path.exists(control_path) else 0):
+                os.unlink(control_path)
+            server = await asyncio.start_unix_server(self._serve_control,
+                                                     path=control_path)
+            os.chmod(control_path, 0o600)
+            logger.info('Control socket: {}'.format(control_path))
+            tasks.append(server.wait_closed())
+        await asyncio.gather(*tasks)
+
+    async def _read_device(self, device):
+        while True:
+            try:
+                events = list(await device.async_read())
+            except OSError as e:
+                logger.warning('Device "{}" lost: {}'.format(device.name, e))
+                self.remove_device(device)
+                return
+            self.feed(device, events, (time.time(), time.monotonic()))
+
+    def _hotplug_async(self):
+        for device in self.hotplug():
+            self._loop.create_task(self._read_device(device))
+
+    async def _send_loop(self):
+        while True:
+            self._publish(*await self._send_queue.get())
+
+    async def _serve_requests(self):
+        import zmq.asyncio
+        shadow = zmq.asyncio.Socket.shadow(self._socket.underlying)
+        while True:
+            self._handle_request(await shadow.recv())
+
+    async def _timer(self, callback, interval):
+        # interval: seconds, or a callable returning them.
+        while True:
+            await asyncio.sleep(interval() if callable(interval) else interval)
+            callback()
+
+    async def _serve_control(self, reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            reply = self.control(line.decode('utf-8', 'replace'))
+            writer.write((reply + '\n').encode('utf-8'))
+            await writer.drain()
+        writer.close()
+
+    def control(self, command):
+        words = command.split()
+        if not words:
+            return ''
+        if words[0] == 'status':
+            if self._group is not None:
+                return 'group: {} ({})'.format(
+                            self._group['name'],
+                            ', '.join(self._group['members']))
+            return 'sub: {} ({})'.format(self.current_sub['name'],
+                                         self._current_idx)
+        if words[0] == 'next':
+            self._leave_targets()
+            self.next()
+            return 'sub: {}'.format(self.current_sub['name'])
+        if words[0] == 'switch' and len(words) == 2:
+            names = [s['name'] for s in self._subs]
+            groups = [g['name'] for g in self._groups]
+            if words[1] not in names and words[1] in groups:
+                self._leave_targets()
+                self.switch_group(groups.index(words[1]))
+                return 'group: {}'.format(words[1])
+            if words[1] in names:
+                idx = names.index(words[1])
+            elif words[1].isdigit() and int(words[1]) < len(self._subs):
+                idx = int(words[1])
+            else:
+                return 'error: unknown sub "{}"'.format(words[1])
+            self._leave_targets()
+            self.switch(idx)
+            return 'sub: {}'.format(self.current_sub['name'])
+        if words[0] == 'exit':
+            self.exit_program('Exit requested')
+        return 'error: unknown command "{}"'.format(command.strip())
+
+
+def load_config(config_file=None):
+    # yaml is only needed here, so it's not imported with the module.
+    import shutil
+    import yaml
+    if config_file is None:
+        logger.info('Config file not specified. Using default.')
+        config_file = os.path.expanduser("~") + '/.local/kybonet/config.yml'
+        dir_name = os.path.dirname(config_file)
+        if not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+        if not os.path.isfile(config_file):
+            default_config_file = kybonet.__path__[0] + '/config.yml'
+            shutil.copyfile(default_config_file, config_file)
+    assert os.path.isfile(config_file), \
+        'File not found: {}'.format(config_file)
+    logger.info('Loading config file: {}'.format(config_file))
+    with open(config_file, 'r') as f:
+        return yaml.load(f.read(), Loader=yaml.FullLoader)
 
 
 def main(args=None):
@@ -279,33 +1324,50 @@ def main(args=None):
 
     logging.basicConfig(level=log_level, format=log_fmt)
 
-    if args.config:
-        config_file = args.config
+    config = load_config(args.config)
+
+    coalesce = config.get('coalesce') or {}
+    if coalesce.get('window_ms'):
+        coalescer = MotionCoalescer(
+                        window=coalesce['window_ms'] / 1000,
+                        min_window=coalesce.get('min_ms', 2) / 1000,
+                        max_window=coalesce.get('max_ms', 8) / 1000,
+                        adaptive=coalesce.get('adaptive', True))
     else:
-        logger.info('Config file not specified. Using default.')
-        config_file = os.path.expanduser("~") + '/.local/kybonet/config.yml'
-        dir_name = os.path.dirname(config_file)
-        if not os.path.isdir(dir_name):
-            os.makedirs(dir_name)
-        if not os.path.isfile(config_file):
-            default_config_file = kybonet.__path__[0] + '/config.yml'
-            shutil.copyfile(default_config_file, config_file)
-    assert os.path.isfile(config_file), 'File not found: {}'.format(config_file)
-    logger.info('Loading config file: {}'.format(config_file))
-    with open(config_file, 'r') as f:
-        config = yaml.load(f.read(), Loader=yaml.FullLoader)
+        coalescer = None
 
-    server = KybonetServer()
+    server = KybonetServer(
+                encryption=config.get('encryption', 'session'),
+                rekey_interval=config.get('rekey_interval', 300),
+                coalescer=coalescer,
+                send_hwm=args.send_hwm,
+                backlog_limit=args.backlog_limit,
+                inputs=SyntheticInputs(keyboard_rate=args.keyboard_rate,
+                                       mouse_rate=args.mouse_rate)
+                if args.synthetic else None)
     server.connect(port=args.port)
+    if args.udp_port:
+        if config.get('encryption', 'session') != 'session':
+            logger.error('--udp-port requires session encryption')
+            sys.exit(1)
+        server.bind_datagram(args.udp_port)
 
-    for s in config['subscribers']:
-        server.add_subscriber(**s)
+    try:
+        for s in config['subscribers']:
+            server.add_subscriber(**s)
+        for g in config.get('groups') or ():
+            server.add_group(**g)
+    except (InvalidHotkey, UnknownSubscriber, InvalidGroup) as e:
+        logger.error(e)
+        sys.exit(1)
 
     if len(server.subs) == 0:
         logger.error('No subscribers available')
         sys.exit(1)
 
     server.scan_devices()
+    if args.synthetic:
+        config['devices'] = [info.name for info in server.devices_connected]
     for d in config['devices']:
         try:
             server.add_device(d)
@@ -315,13 +1377,30 @@ def main(args=None):
     if len(server.devices) == 0:
         logger.error('No devices available')
         sys.exit(1)
+    if not args.synthetic:
+        server.watch_devices()
+    if args.record:
+        server.record(args.record)
 
     for name, key in config['hotkeys'].items():
         if key:
-            server.assign_hotkey(name, key)
+            try:
+                server.assign_hotkey(name, key)
+            except (UnknownHotkey, InvalidHotkey) as e:
+                logger.error(e)
+                sys.exit(1)
 
     logger.info('Kybonet server running on port {}'.format(args.port))
-    server.run()
+    if args.control and not args.asyncio:
+        logger.warning('--control requires --asyncio, ignored.')
+    if args.asyncio:
+        server.run_async(control_path=args.control)
+    elif args.pipeline:
+        server.run_pipelined(queue_size=args.queue_size,
+                             stats_interval=args.stats_interval)
+    else:
+        server.run()
+    server.stop_recording()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,129 @@
+import bisect
+from collections import deque
+
+
+class LatencyHistogram:
+    # Log-scale buckets (each one `factor` times wider than the previous),
+    # from `lowest` to `highest` seconds. Values are kept as counts only, so
+    # the memory used doesn't depend on the number of samples.
+    def __init__(self, lowest=1e-5, highest=10.0, factor=1.2):
+        self._edges = []
+        edge = lowest
+        while edge < highest:
+            self._edges.append(edge)
+            edge *= factor
+        self._edges.append(highest)
+        self.reset()
+
+    def reset(self):
+        self._counts = [0] * (len(self._edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        value = max(value, 0.0)
+        self._counts[bisect.bisect_left(self._edges, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.0
+        target = p / 100 * self.count
+        accumulated = 0
+        for idx, count in enumerate(self._counts):
+            accumulated += count
+            if accumulated >= target and count:
+                if idx < len(self._edges):
+                    return min(self._edges[idx], self.max)
+                return self.max
+        return self.max
+
+    def summary(self):
+        mean = self.total / self.count if self.count else 0.0
+        return {'count': self.count,
+                'mean_ms': mean * 1e3,
+                'p50_ms': self.percentile(50) * 1e3,
+                'p99_ms': self.percentile(99) * 1e3,
+                'max_ms': self.max * 1e3}
+
+    def __str__(self):
+        fmt = 'n={count} mean={mean_ms:.2f}ms p50={p50_ms:.2f}ms ' \
+              'p99={p99_ms:.2f}ms max={max_ms:.2f}ms'
+        return fmt.format(**self.summary())
+
+
+class ClockOffset:
+    # NTP-like estimation of (remote clock - local clock) from ping/pong
+    # exchanges. The sample with the smallest round trip is the one with the
+    # least queuing noise, so that's the one used.
+    def __init__(self, samples=8):
+        self._samples = deque(maxlen=samples)
+
+    def add(self, sent, remote, received):
+        rtt = received - sent
+        if rtt < 0:
+            return
+        self._samples.append((rtt, remote - (sent + received) / 2))
+
+    @property
+    def offset(self):
+        if not self._samples:
+            return None
+        return min(self._samples)[1]
+
+    @property
+    def rtt(self):
+        if not self._samples:
+            return None
+        return min(self._samples)[0]
+
+
+class LatencyTracer:
+    # Input-to-injection latency of the events received by a client, split
+    # by stage. Times measured in the server are converted to the client
+    # clock with the estimated clock offset.
+    stages = ('read', 'encrypt', 'network', 'decrypt', 'inject')
+    classes = ('key', 'motion')
+
+    def __init__(self):
+        self.clock = ClockOffset()
+        self.histograms = {name: LatencyHistogram()
+                           for name in self.stages + self.classes}
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
+
+    def record(self, events, trace, received, decrypted, injected):
+        # trace: (read, encrypted) as sent by the server; network starts
+        # once it's encrypted and includes the send call.
+        # received, decrypted, injected: client wall clock times.
+        h = self.histograms
+        h['decrypt'].add(decrypted - received)
+        h['inject'].add(injected - decrypted)
+        if trace is None:
+            return
+        read, encrypted = trace
+        h['encrypt'].add(encrypted)
+        for event in events:
+            h['read'].add(read - event.time)
+        offset = self.clock.offset
+        if offset is None:
+            return
+        h['network'].add(received + offset - (read + encrypted))
+        for event in events:
+            name = 'motion' if event.is_rel_movement() else 'key'
+            h[name].add(injected + offset - event.time)
+
+    def report(self):
+        lines = []
+        if self.clock.offset is not None:
+            lines.append('clock offset {:+.3f}ms (rtt {:.3f}ms)'.format(
+                            self.clock.offset * 1e3, self.clock.rtt * 1e3))
+        for name in self.classes + self.stages:
+            if self.histograms[name].count:
+                lines.append('{:<8} {}'.format(name, self.histograms[name]))
+        return lines
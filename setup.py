@@ -42,7 +42,10 @@ setup(name='kybonet',
                         'kybonet-server=kybonet.server:main',
                         'kybonet-client=kybonet.client:main',
                         'kybonet-keygen=kybonet.crypto:main',
-                        'kybonet-devices=kybonet.input_devices:main']},
+                        'kybonet-devices=kybonet.input_devices:main',
+                        'kybonet-bench=kybonet.bench:main',
+                        'kybonet-replay=kybonet.replay:main',
+                        'kybonet-loadtest=kybonet.loadtest:main']},
       project_urls={
           "Source Code": "https://github.com/akukulanski/kybonet",
           "Bug Tracker": "https://github.com/akukulanski/kybonet/issues",